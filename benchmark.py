@@ -0,0 +1,295 @@
+import argparse
+import glob
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import check
+import ricetify
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Strings every mod_js and inject_apps patch looks for, placed at random offsets in the generated bundles
+JS_ANCHORS = {
+    "zlink.bundle.js": [
+        'this._initialState.isHomeEnabled',
+        'isHomeEnabled?void 0:_flowControl',
+        '(0,_productState.hasValue)("radio","1")',
+        'lyricsEnabled(trackHasLyrics&&(t.isLyricsEnabled))',
+        'PlayerUI.prototype.setup=function(){',
+        'const metadata=data.track.metadata;',
+        '_localStorage2.default.get(SETTINGS_KEY_AD);',
+        'BuddyList.prototype.setup=function(){',
+        'PlayerHelper.prototype._player=null',
+        'const Adaptor=function(bridge,cosmos){',
+        'this._uri=track.uri,this._trackMetadata=track.metadata',
+        'this.playing(data.is_playing&&!data.is_paused),this._update();',
+        'PlayerUI.prototype._onProgressBarProgress=function(e){',
+        'var _spotifyCosmosApi2=_interopRequireDefault(_spotifyCosmosApi);',
+        'PAGE_LOGGER_MAP={',
+        'return _pageIdentifiers2.default[normalizedAppId]||_pageIdentifiers.default.unknownUncovered',
+        'NavigationBar.prototype._initCollectionSection=function(){',
+    ],
+    "settings.bundle.js": ['const isEmployee = false;'],
+    "lyrics.bundle.js": ['const anyAbLyricsEnabled = false;', 'trackController.init(trackControllerOpts)'],
+}
+
+JS_TOKENS = ['function', 'return', 'var', 'this', '(', ')', '{', '}', ';', ',', '=', '&&', '||', '.', 'e', 't', 'n',
+             'prototype', 'default', '_interop', 'null', 'void 0', '!0', '!1', '"spotify:app"', 'define']
+
+CSS_PROPERTIES = ['display:flex', 'position:relative', 'font-size:14px', 'margin:0 auto', 'padding:8px 16px',
+                  'transition:all .2s ease', 'z-index:3', 'line-height:1.5', 'overflow:hidden', 'cursor:pointer']
+
+
+def generate_css(rng, size):
+    # Mostly plain declarations with every colour convert_css knows about, plus colours it leaves alone
+    colours = [pattern for pattern, _ in ricetify.CSS_REPLACEMENTS if "\\" not in pattern]
+    colours += ['rgba(0, 0, 0, 0.5)', 'rgba(0,0,0,.3)', 'rgba(255, 255, 255, 0.1)', 'rgba(179, 179, 179, 0.6)',
+                '#123456', '#abc', 'rgba(1, 2, 3, 0.4)', 'transparent']
+    rules = []
+    length = 0
+    while length < size:
+        declarations = rng.sample(CSS_PROPERTIES, 3)
+        for _ in range(rng.randint(0, 2)):
+            colour = rng.choice(colours)
+            declarations.append(f"{rng.choice(['color', 'background-color', 'border'])}:{colour.strip(' ;')}")
+        rule = f".c{rng.getrandbits(32):x} .{rng.choice(['btn', 'row', 'nav', 'card'])}{{{';'.join(declarations)}}}"
+        rules.append(rule)
+        length += len(rule)
+    return "\n".join(rules)
+
+
+def generate_bundle(rng, js_filename, size):
+    # A single minified line like the real bundles, which is where unanchored .*? patterns get expensive
+    chunks = []
+    length = 0
+    while length < size:
+        chunk = "".join(rng.choice(JS_TOKENS) for _ in range(64))
+        chunks.append(chunk)
+        length += len(chunk)
+    for anchor in JS_ANCHORS.get(js_filename, []):
+        chunks.insert(rng.randrange(len(chunks) + 1), anchor)
+    return "".join(chunks)
+
+
+def generate_corpus(corpus_dir, spa_count, css_size, bundle_size, seed):
+    rng = random.Random(seed)
+    glue = generate_css(rng, css_size)
+    names = ["zlink", "settings", "lyrics"] + [f"app{index:02d}" for index in range(max(spa_count - 3, 0))]
+    for name in names[:max(spa_count, 3)]:
+        with zipfile.ZipFile(os.path.join(corpus_dir, f"{name}.spa"), "w", zipfile.ZIP_DEFLATED) as spa:
+            spa.writestr("index.html", f"<!DOCTYPE html><html><head><title>{name}</title>"
+                                       f"<link rel=\"stylesheet\" href=\"css/glue.css\"></head>"
+                                       f"<body><div id=\"{name}\"></div></body></html>")
+            spa.writestr("css/glue.css", glue)
+            spa.writestr(f"css/{name}.css", generate_css(rng, css_size // 2))
+            js_filename = f"{name}.bundle.js"
+            spa.writestr(js_filename, generate_bundle(rng, js_filename,
+                                                      bundle_size if name == "zlink" else bundle_size // 10))
+            spa.writestr("i18n/en.json", json.dumps({f"key{index}": f"value {index}" for index in range(200)}))
+            for index in range(4):
+                spa.writestr(f"images/image{index}.png", rng.getrandbits(8 * 8192).to_bytes(8192, "little"),
+                             zipfile.ZIP_STORED)
+
+
+def timed(results, stage, function, *args):
+    start = time.perf_counter()
+    function(*args)
+    results.setdefault(stage, []).append(time.perf_counter() - start)
+
+
+def extract(work):
+    for file, folder in zip(work["files"], work["folders"]):
+        with zipfile.ZipFile(file) as spa:
+            spa.extractall(folder)
+
+
+def process_css(work):
+    for folder in work["folders"]:
+        ricetify.process_css(folder)
+        ricetify.inject_css(folder, None)
+
+
+def process_html(work):
+    for folder in work["folders"]:
+        ricetify.process_html(folder, work["extensions"])
+
+
+def mod_js(work):
+    plan = ricetify.PatchPlan()
+    ricetify.mod_js(plan, work["extensions"])
+    for folder in work["folders"]:
+        plan.apply(folder)
+
+
+def create_apps(work):
+    plan = ricetify.PatchPlan()
+    ricetify.create_apps(plan, [work["app_dir"]], work["output_dir"])
+    for folder in work["folders"]:
+        plan.apply(folder)
+
+
+def compile_archives(work):
+    for folder in work["folders"]:
+        output_file = os.path.join(work["output_dir"], os.path.basename(folder))
+        shutil.make_archive(output_file, "zip", folder)
+        shutil.move(output_file + ".zip", output_file)
+
+
+def stream(work):
+    plan = ricetify.PatchPlan()
+    ricetify.mod_js(plan, work["extensions"])
+    ricetify.create_apps(plan, [work["app_dir"]], work["output_dir"])
+    ricetify.current_builder().css_memo.clear()
+    for file in work["files"]:
+        ricetify.stream_spa(file, os.path.join(work["output_dir"], os.path.basename(file)), plan, work["extensions"],
+                            None)
+
+
+def idle(work):
+    pass
+
+
+# The extraction pipeline in order, every stage works on what the one before it left on disk
+STAGES = [("extract", extract), ("process_css", process_css), ("process_html", process_html), ("mod_js", mod_js),
+          ("create_apps", create_apps), ("compile", compile_archives), ("stream", stream)]
+
+
+def prepare_work(corpus_dir, work_dir, app_dir, extensions):
+    files = sorted(glob.glob(os.path.join(corpus_dir, "*.spa")))
+    work = {"files": files, "folders": [os.path.join(work_dir, "extracted", os.path.basename(file)) for file in files],
+            "output_dir": os.path.join(work_dir, "output"), "app_dir": app_dir, "extensions": extensions}
+    os.makedirs(work["output_dir"])
+    return work
+
+
+def run_stages(corpus_dir, work_dir, app_dir, extensions):
+    # Runs the extraction pipeline one stage at a time over every archive so each stage can be timed on its own
+    results = {}
+    work = prepare_work(corpus_dir, work_dir, app_dir, extensions)
+    ricetify.current_builder().css_memo.clear()
+    for stage, function in STAGES:
+        timed(results, stage, function, work)
+    return results
+
+
+def peak_rss():
+    # Peak resident set size of this process in MB, kB on Linux and bytes on macOS
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+def measure_stage(function, work, config):
+    # Runs in a fresh worker process, so its peak RSS belongs to this stage alone (on top of what an idle worker
+    # needs) and also covers mmapped files, which tracemalloc doesn't see
+    with ricetify.Builder(config) as builder, builder.activate():
+        tracemalloc.start()
+        function(work)
+        allocated = tracemalloc.get_traced_memory()[1] / (1 << 20)
+        tracemalloc.stop()
+    return peak_rss(), allocated
+
+
+def measure_stages(corpus_dir, work_dir, app_dir, extensions, config):
+    # (peak RSS, peak allocation) in MB of every stage, each run in a process of its own. Tracing slows stages down,
+    # so this is a separate untimed run.
+    work = prepare_work(corpus_dir, work_dir, app_dir, extensions)
+    memory = {}
+    for stage, function in [("idle worker", idle)] + STAGES:
+        with ProcessPoolExecutor(1) as pool:
+            memory[stage] = pool.submit(measure_stage, function, work, config).result()
+    return memory
+
+
+def check_convert_css(corpus_dir):
+    # The single pass engine has to match applying the replacement table one re.sub at a time, byte for byte
+    results = {}
+    for file in sorted(glob.glob(os.path.join(corpus_dir, "*.spa"))):
+        with zipfile.ZipFile(file) as spa:
+            for name in spa.namelist():
+                if not name.endswith(".css"):
+                    continue
+                css_data = spa.read(name)
+                start = time.perf_counter()
+                expected = check.convert_css_sequential(css_data)
+                results.setdefault("convert_css (sequential)", [0.0])[0] += time.perf_counter() - start
+                start = time.perf_counter()
+                converted = ricetify.convert_css(css_data)
+                results.setdefault("convert_css (single pass)", [0.0])[0] += time.perf_counter() - start
+                if converted != expected:
+                    sys.exit(f"convert_css output differs from the sequential replacements in {file}/{name}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ricetify on a synthetic Spotify install")
+    parser.add_argument('-n', '--spas', help='Number of archives to generate', type=int, default=40)
+    parser.add_argument('--css-kb', help='Size of each glue.css in kB', type=int, default=256)
+    parser.add_argument('--bundle-kb', help='Size of zlink.bundle.js in kB', type=int, default=4096)
+    parser.add_argument('-r', '--repeat', help='Number of times to run every stage', type=int, default=3)
+    parser.add_argument('-s', '--seed', help='Seed for the generated corpus', type=int, default=0)
+    parser.add_argument('-c', '--config', help="Config file to benchmark with", type=ricetify.is_file,
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "ricetify.conf"))
+    parser.add_argument('--json', help='Write the results to a JSON file')
+    args = parser.parse_args()
+
+    with ricetify.Builder(args.config) as builder, builder.activate(), tempfile.TemporaryDirectory() as temp_dir:
+        corpus_dir = os.path.join(temp_dir, "corpus")
+        os.makedirs(corpus_dir)
+        app_dir = os.path.join(temp_dir, "benchapp")
+        os.makedirs(os.path.join(app_dir, "assets"))
+        with open(os.path.join(app_dir, "index.html"), "w") as index:
+            index.write("<html><!-- // NAME:Benchmark App\n--></html>")
+        extension = os.path.join(temp_dir, "extension.js")
+        with open(extension, "w") as extension_file:
+            extension_file.write("console.log('extension')")
+
+        start = time.perf_counter()
+        generate_corpus(corpus_dir, args.spas, args.css_kb << 10, args.bundle_kb << 10, args.seed)
+        corpus_size = sum(os.path.getsize(file) for file in glob.glob(os.path.join(corpus_dir, "*.spa")))
+        print(f"Generated {args.spas} archives ({corpus_size / (1 << 20):.1f} MB) "
+              f"in {time.perf_counter() - start:.2f}s")
+
+        results = check_convert_css(corpus_dir)
+        for repetition in range(args.repeat):
+            work_dir = os.path.join(temp_dir, f"run{repetition}")
+            stage_results = run_stages(corpus_dir, work_dir, app_dir, [extension])
+            for stage, times in stage_results.items():
+                results.setdefault(stage, []).extend(times)
+            shutil.rmtree(work_dir)
+        memory = measure_stages(corpus_dir, os.path.join(temp_dir, "memory"), app_dir, [extension], args.config)
+
+    print(f"{'stage':<28}{'best (s)':>10}{'mean (s)':>10}{'peak RSS (MB)':>15}{'peak alloc (MB)':>17}")
+    for stage in list(results) + ["idle worker"]:
+        times = results.get(stage)
+        rss, allocated = memory.get(stage, (None, None))
+        columns = [f"{min(times):.3f}", f"{sum(times) / len(times):.3f}"] if times else ["-", "-"]
+        columns += [f"{value:.1f}" if value is not None else "-" for value in (rss, allocated)]
+        print(f"{stage:<28}{columns[0]:>10}{columns[1]:>10}{columns[2]:>15}{columns[3]:>17}")
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump({"corpus": {"spas": args.spas, "css_kb": args.css_kb, "bundle_kb": args.bundle_kb,
+                                  "seed": args.seed, "bytes": corpus_size},
+                       "stages": {stage: {"best": min(times), "mean": sum(times) / len(times),
+                                          "peak_rss_mb": memory.get(stage, (None, None))[0],
+                                          "peak_alloc_mb": memory.get(stage, (None, None))[1]}
+                                  for stage, times in results.items()},
+                       "idle_worker_peak_rss_mb": memory["idle worker"][0]},
+                      json_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import argparse
+import contextlib
+import glob
+import io
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import zipfile
+
+import ricetify
+
+
+def convert_css_sequential(css_data):
+    # What convert_css did before the single pass engine: one re.sub per replacement, in table order
+    for pattern, repl in ricetify.CSS_REPLACEMENTS:
+        css_data = re.sub(pattern.encode(), repl.encode(), css_data)
+    return css_data
+
+
+def check_convert_css(spa_dir):
+    # convert_css has to match the sequential replacements byte for byte on Spotify's own stylesheets
+    files = sorted(glob.glob(os.path.join(spa_dir, "*.spa")))
+    if not files:
+        print(f"convert_css: skipped, no archives in {spa_dir}")
+        return
+    stylesheets = 0
+    for file in files:
+        with zipfile.ZipFile(file) as spa:
+            for name in spa.namelist():
+                if not name.endswith(".css"):
+                    continue
+                css_data = spa.read(name)
+                if ricetify.convert_css(css_data) != convert_css_sequential(css_data):
+                    sys.exit(f"convert_css output differs from the sequential replacements in {file}/{name}")
+                stylesheets += 1
+    print(f"convert_css: ok, {stylesheets} stylesheets in {len(files)} archives")
+
+
+def check_convert_css_fuzz(cases, seed):
+    # Random runs of colours and separators, which is where hits overlap and the engine falls back to sequential
+    # replacements, e.g. " white black;" where " white " takes the space " black;" needs
+    tokens = [pattern for pattern, _ in ricetify.CSS_REPLACEMENTS if "\\" not in pattern]
+    tokens += ['rgba(0, 0, 0, 0.5)', 'rgba(0,0,0,1)', 'rgba(40,40,40,.3)', 'rgba(255, 255, 255, 0.1)', '#fff',
+               '#fffff', '#000000', ' ', ';', 'x', '{', '}', 'color:', '#', 'white', 'black', ' lightgray', ' gray']
+    rng = random.Random(seed)
+    css = [b" white black;"] + [("".join(rng.choice(tokens) for _ in range(rng.randint(1, 8)))).encode()
+                                 for _ in range(cases)]
+    for css_data in css:
+        if ricetify.convert_css(css_data) != convert_css_sequential(css_data):
+            sys.exit(f"convert_css output differs from the sequential replacements for {css_data!r}")
+    print(f"convert_css fuzz: ok, {len(css)} cases")
+
+
+def check_scan_colours():
+    # The analyzer only reports colours in declaration values, never selectors, url() fragments, comments or strings
+    css = (b'#fade{color:#fff}a:hover #abc{color:red}.u{background:url(#abc) #123;filter:url("#def")}\n'
+           b'@media (max-width:100px){.a:hover .b{color:navy}#cab{border:1px solid black}}\n'
+           b'/* color:#eee */.s{content:"#ddd";color:rgba(0,0,0,.3)}.last{color:#000')
+    found = [literal for literal, _, _, _ in ricetify.scan_colours(css)]
+    expected = ["#fff", "red", "#123", "navy", "black", "rgba(0,0,0,.3)", "#000"]
+    if found != expected:
+        sys.exit(f"scan_colours found {found} instead of {expected}")
+    print("scan_colours: ok")
+
+
+def check_app_name():
+    # App names come from index.html, which may be in any encoding whatever the locale
+    with tempfile.TemporaryDirectory() as app_dir:
+        with open(os.path.join(app_dir, "index.html"), "wb") as index:
+            index.write("<html><!-- été \n// NAME:Café App\n--></html>".encode() + b"\xff")
+        name = ricetify.get_app_name(app_dir)
+    if name != "Café App":
+        sys.exit(f"get_app_name read {name!r} instead of 'Café App'")
+    print("get_app_name: ok")
+
+
+def check_sync_dir():
+    # Apps are synced into the output folder, which is "." when -o isn't given, so relative and unnormalized
+    # destinations have to keep the files they just copied
+    with tempfile.TemporaryDirectory() as temp_dir:
+        app_dir = os.path.join(temp_dir, "app")
+        os.makedirs(os.path.join(app_dir, "assets"))
+        for name in ["index.html", os.path.join("assets", "app.js")]:
+            with open(os.path.join(app_dir, name), "w") as app_file:
+                app_file.write(name)
+        work_dir = os.path.join(temp_dir, "output")
+        os.makedirs(work_dir)
+        previous_dir = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            for destination in ["./app", "app", os.path.join(os.curdir, "nested", os.pardir, "app")]:
+                ricetify.sync_dir(app_dir, destination)
+                copied, removed = ricetify.sync_dir(app_dir, destination)
+                found = sorted(os.path.relpath(os.path.join(root, name), "app")
+                               for root, _, names in os.walk("app") for name in names)
+                if found != [os.path.join("assets", "app.js"), "index.html"] or (copied, removed) != (0, 0):
+                    sys.exit(f"sync_dir to {destination} left {found}, copied {copied} and removed {removed} files "
+                             f"on the second run")
+        finally:
+            os.chdir(previous_dir)
+    print("sync_dir: ok")
+
+
+def make_spotify(spotify_dir, archives):
+    # A small Spotify install: a client executable to fingerprint the version from and archives with stylesheets
+    os.makedirs(os.path.join(spotify_dir, "Apps"))
+    with open(os.path.join(spotify_dir, "spotify"), "w") as executable:
+        executable.write("spotify")
+    css = ".a{color:#1ed760;background:#282828}.b{border:1px solid black;color:rgba(0, 0, 0, 0.5)}\n" * 64
+    for index in range(archives):
+        name = "zlink" if index == 0 else f"app{index:02d}"
+        with zipfile.ZipFile(os.path.join(spotify_dir, "Apps", f"{name}.spa"), "w", zipfile.ZIP_DEFLATED) as spa:
+            spa.writestr("index.html", f"<html><head><title>{name}</title></head><body></body></html>")
+            spa.writestr("css/glue.css", css)
+            spa.writestr(f"css/{name}.css", css.replace("#282828", f"#{index:06x}"))
+            spa.writestr(f"{name}.bundle.js", f"console.log('{name}')")
+
+
+def check_threaded_builds(threads, builds):
+    # Builders in threads of one process share the backup and ~/.ricetify_cache, where they evict each other's
+    # entries all the time, and still have to build exactly what a builder on its own would
+    if ricetify.OS != "linux":
+        print("threaded builds: skipped, the Spotify version is only faked on Linux")
+        return
+    with tempfile.TemporaryDirectory() as temp_dir:
+        spotify_dir = os.path.join(temp_dir, "spotify")
+        make_spotify(spotify_dir, 6)
+        errors = []
+
+        def colours(thread, build):
+            return {"Colours": dict(ricetify.default_colors, main_bg=f"#{thread:02x}{build:02x}40")}
+
+        def run(thread):
+            os.makedirs(os.path.join(temp_dir, "output", str(thread)))
+            try:
+                for build in range(builds):
+                    with ricetify.Builder(colours(thread, build), home_dir=temp_dir,
+                                          spotify_path=spotify_dir) as builder:
+                        builder.build(os.path.join(temp_dir, "output", str(thread)), stream=build % 2 == 1)
+            except Exception as error:
+                errors.append(f"thread {thread}: {error!r}")
+
+        workers = [threading.Thread(target=run, args=(thread,)) for thread in range(threads)]
+        # Every build reports what it changed
+        with contextlib.redirect_stdout(io.StringIO()):
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        if errors:
+            sys.exit("Threaded builds failed:\n" + "\n".join(errors))
+
+        for thread in range(threads):
+            output_dir = os.path.join(temp_dir, "output", str(thread))
+            reference_dir = os.path.join(temp_dir, "reference", str(thread))
+            os.makedirs(reference_dir)
+            builder = ricetify.Builder(colours(thread, builds - 1), home_dir=temp_dir, spotify_path=spotify_dir)
+            with builder, contextlib.redirect_stdout(io.StringIO()):
+                builder.build(reference_dir, stream=(builds - 1) % 2 == 1, cache=False)
+            for file in sorted(glob.glob(os.path.join(reference_dir, "*.spa"))):
+                output_file = os.path.join(output_dir, os.path.basename(file))
+                if ricetify.archive_contents(output_file) != ricetify.archive_contents(file):
+                    sys.exit(f"Threaded build of {output_file} differs from building it on its own")
+    print(f"threaded builds: ok, {threads} threads with {builds} builds each")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check ricetify against its reference behaviour")
+    parser.add_argument('--spa-dir', help="Folder with Spotify's archives to check convert_css on (defaults to the "
+                                          "backup)")
+    parser.add_argument('-n', '--fuzz', help='Number of random stylesheets to check convert_css on', type=int,
+                        default=20000)
+    parser.add_argument('-s', '--seed', help='Seed for the random stylesheets', type=int, default=0)
+    parser.add_argument('-t', '--threads', help='Number of builders to run at once in threads', type=int, default=8)
+    args = parser.parse_args()
+
+    with ricetify.Builder() as builder, builder.activate():
+        check_convert_css(args.spa_dir or builder.backup_dir)
+        check_convert_css_fuzz(args.fuzz, args.seed)
+        check_scan_colours()
+        check_app_name()
+        check_sync_dir()
+    check_threaded_builds(args.threads, 6)
+
+
+if __name__ == "__main__":
+    main()
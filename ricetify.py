@@ -1,32 +1,86 @@
 import argparse
+import bisect
 import configparser
+import contextlib
+import copy
+import cProfile
 import glob
+import hashlib
+import mmap
+import json
 import os
 import re
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-OS = sys.platform
-if OS == "linux":
-    SPOTIFY_PATH = "/usr/share/spotify"
-elif OS == "darwin":
-    # TODO find where the folder is
-    SPOTIFY_PATH = ""
-elif OS == "win32":
-    SPOTIFY_PATH = os.path.join(os.getenv('APPDATA'), "Spotify")
-
-RICETIFY_FOLDER = os.path.dirname(sys.argv[0])
 
-GLOBAL_VERBOSITY = 0
+OS = sys.platform
 
-CONFIG = configparser.ConfigParser()
+# The Builder running in each thread, see current_builder()
+BUILDERS = threading.local()
+
+DEFAULT_BUILDER = None
+
+# Builders running in threads of one process share the backup
+BACKUP_LOCK = threading.Lock()
+
+# App names read from index.html, by path, size and modification time
+APP_NAMES = {}
+
+# How many characters a JS patch may match, counted from its anchor
+JS_PATCH_WINDOW = 4096
+
+# Seconds between two polls of the inputs in --watch mode
+WATCH_INTERVAL = 0.5
+
+# CSS named colours, all of which the analyzer looks for in Spotify's stylesheets
+NAMED_COLOURS = {
+    "aliceblue": "#f0f8ff", "antiquewhite": "#faebd7", "aqua": "#00ffff", "aquamarine": "#7fffd4", "azure": "#f0ffff",
+    "beige": "#f5f5dc", "bisque": "#ffe4c4", "black": "#000000", "blanchedalmond": "#ffebcd", "blue": "#0000ff",
+    "blueviolet": "#8a2be2", "brown": "#a52a2a", "burlywood": "#deb887", "cadetblue": "#5f9ea0",
+    "chartreuse": "#7fff00", "chocolate": "#d2691e", "coral": "#ff7f50", "cornflowerblue": "#6495ed",
+    "cornsilk": "#fff8dc", "crimson": "#dc143c", "cyan": "#00ffff", "darkblue": "#00008b", "darkcyan": "#008b8b",
+    "darkgoldenrod": "#b8860b", "darkgray": "#a9a9a9", "darkgreen": "#006400", "darkgrey": "#a9a9a9",
+    "darkkhaki": "#bdb76b", "darkmagenta": "#8b008b", "darkolivegreen": "#556b2f", "darkorange": "#ff8c00",
+    "darkorchid": "#9932cc", "darkred": "#8b0000", "darksalmon": "#e9967a", "darkseagreen": "#8fbc8f",
+    "darkslateblue": "#483d8b", "darkslategray": "#2f4f4f", "darkslategrey": "#2f4f4f", "darkturquoise": "#00ced1",
+    "darkviolet": "#9400d3", "deeppink": "#ff1493", "deepskyblue": "#00bfff", "dimgray": "#696969",
+    "dimgrey": "#696969", "dodgerblue": "#1e90ff", "firebrick": "#b22222", "floralwhite": "#fffaf0",
+    "forestgreen": "#228b22", "fuchsia": "#ff00ff", "gainsboro": "#dcdcdc", "ghostwhite": "#f8f8ff", "gold": "#ffd700",
+    "goldenrod": "#daa520", "gray": "#808080", "green": "#008000", "greenyellow": "#adff2f", "grey": "#808080",
+    "honeydew": "#f0fff0", "hotpink": "#ff69b4", "indianred": "#cd5c5c", "indigo": "#4b0082", "ivory": "#fffff0",
+    "khaki": "#f0e68c", "lavender": "#e6e6fa", "lavenderblush": "#fff0f5", "lawngreen": "#7cfc00",
+    "lemonchiffon": "#fffacd", "lightblue": "#add8e6", "lightcoral": "#f08080", "lightcyan": "#e0ffff",
+    "lightgoldenrodyellow": "#fafad2", "lightgray": "#d3d3d3", "lightgreen": "#90ee90", "lightgrey": "#d3d3d3",
+    "lightpink": "#ffb6c1", "lightsalmon": "#ffa07a", "lightseagreen": "#20b2aa", "lightskyblue": "#87cefa",
+    "lightslategray": "#778899", "lightslategrey": "#778899", "lightsteelblue": "#b0c4de", "lightyellow": "#ffffe0",
+    "lime": "#00ff00", "limegreen": "#32cd32", "linen": "#faf0e6", "magenta": "#ff00ff", "maroon": "#800000",
+    "mediumaquamarine": "#66cdaa", "mediumblue": "#0000cd", "mediumorchid": "#ba55d3", "mediumpurple": "#9370db",
+    "mediumseagreen": "#3cb371", "mediumslateblue": "#7b68ee", "mediumspringgreen": "#00fa9a",
+    "mediumturquoise": "#48d1cc", "mediumvioletred": "#c71585", "midnightblue": "#191970", "mintcream": "#f5fffa",
+    "mistyrose": "#ffe4e1", "moccasin": "#ffe4b5", "navajowhite": "#ffdead", "navy": "#000080", "oldlace": "#fdf5e6",
+    "olive": "#808000", "olivedrab": "#6b8e23", "orange": "#ffa500", "orangered": "#ff4500", "orchid": "#da70d6",
+    "palegoldenrod": "#eee8aa", "palegreen": "#98fb98", "paleturquoise": "#afeeee", "palevioletred": "#db7093",
+    "papayawhip": "#ffefd5", "peachpuff": "#ffdab9", "peru": "#cd853f", "pink": "#ffc0cb", "plum": "#dda0dd",
+    "powderblue": "#b0e0e6", "purple": "#800080", "rebeccapurple": "#663399", "red": "#ff0000", "rosybrown": "#bc8f8f",
+    "royalblue": "#4169e1", "saddlebrown": "#8b4513", "salmon": "#fa8072", "sandybrown": "#f4a460",
+    "seagreen": "#2e8b57", "seashell": "#fff5ee", "sienna": "#a0522d", "silver": "#c0c0c0", "skyblue": "#87ceeb",
+    "slateblue": "#6a5acd", "slategray": "#708090", "slategrey": "#708090", "snow": "#fffafa", "springgreen": "#00ff7f",
+    "steelblue": "#4682b4", "tan": "#d2b48c", "teal": "#008080", "thistle": "#d8bfd8", "tomato": "#ff6347",
+    "turquoise": "#40e0d0", "violet": "#ee82ee", "wheat": "#f5deb3", "white": "#ffffff", "whitesmoke": "#f5f5f5",
+    "yellow": "#ffff00", "yellowgreen": "#9acd32"
+}
 
-TEMP_DIR = tempfile.TemporaryDirectory()
-TEMP_DIR_PATH = TEMP_DIR.name
+# Compiled by colour_patterns() on first use
+COLOUR_PATTERNS = None
 
 default_colors = {
     "main_fg": "#ffffff",
@@ -48,11 +102,93 @@ default_colors = {
 }
 
 
+class RicetifyError(Exception):
+    # A build that can't go on, main() turns it into an exit with its message
+    pass
+
+
+def default_spotify_path():
+    if OS == "linux":
+        return "/usr/share/spotify"
+    elif OS == "darwin":
+        # TODO find where the folder is
+        return ""
+    elif OS == "win32":
+        return os.path.join(os.getenv('APPDATA'), "Spotify")
+
+
+def default_home_dir():
+    if 'SUDO_USER' in os.environ:
+        return os.path.expanduser(f"~{os.getenv('SUDO_USER')}")
+    else:
+        return str(Path.home())
+
+
+def current_builder():
+    # The builder running in this thread, or a default one for code calling the functions of this module directly
+    global DEFAULT_BUILDER
+
+    builder = getattr(BUILDERS, "builder", None)
+    if builder is not None:
+        return builder
+    if DEFAULT_BUILDER is None:
+        DEFAULT_BUILDER = Builder()
+    return DEFAULT_BUILDER
+
+
 def debug_print(string, verbosity):
-    if verbosity <= GLOBAL_VERBOSITY:
+    if verbosity <= current_builder().verbosity:
         print(string)
 
 
+def add_profile(path, value):
+    # Adds value to the counter at path (a list of keys) in the profile, which stays None unless --profile is given
+    profile = current_builder().profile
+    if profile is None:
+        return
+    node = profile
+    for key in path[:-1]:
+        node = node.setdefault(key, {})
+    node[path[-1]] = node.get(path[-1], 0) + value
+
+
+def merge_profile(target, source):
+    for key, value in source.items():
+        if isinstance(value, dict):
+            merge_profile(target.setdefault(key, {}), value)
+        else:
+            target[key] = target.get(key, 0) + value
+
+
+def add_overhead(seconds):
+    # Time spent measuring rather than building, which profile_stage() takes off every stage it happened in
+    builder = current_builder()
+    builder.profile_overhead += seconds
+    add_profile(["profiler_overhead"], seconds)
+
+
+@contextlib.contextmanager
+def profile_stage(stage, filename=None):
+    builder = current_builder()
+    if builder.profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    overhead = builder.profile_overhead
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start - (builder.profile_overhead - overhead)
+        add_profile(["stages", stage], elapsed)
+        if filename is not None:
+            add_profile(["files", filename, "stages", stage], elapsed)
+
+
+def profile_io(filename, bytes_read, bytes_written):
+    add_profile(["files", filename, "bytes_read"], bytes_read)
+    add_profile(["files", filename, "bytes_written"], bytes_written)
+
+
 def hex_to_rgb(hex_code):
     r = int(hex_code[1:3], 16)
     g = int(hex_code[3:5], 16)
@@ -61,101 +197,434 @@ def hex_to_rgb(hex_code):
 
 
 def get_spotify_version():
+    # Starting the client just to ask for its version is slow and can hang on a headless machine, so package metadata
+    # and a fingerprint of the executable (which ricetify never touches) are tried first
     if OS == 'linux':
-        ver = subprocess.run(["spotify", "--version"], stdout=subprocess.PIPE)
-        return str(ver.stdout.split()[2][:-1])
+        if os.path.isfile("/var/lib/dpkg/status"):
+            with open("/var/lib/dpkg/status", errors="replace") as status:
+                package = re.search(r"^Package: spotify-client\n(?:.+\n)*?Version: (.*)$", status.read(), re.MULTILINE)
+            if package:
+                return package.group(1)
+        executable = os.path.join(current_builder().spotify_path, "spotify")
     elif OS == 'darwin':
         # TODO find out how to do this
-        pass
+        return None
     elif OS == 'win32':
-        with open(os.path.join(SPOTIFY_PATH, "prefs")) as prefs:
-            return re.match(r"app\.last-launched-version=\"(.*)\"", prefs.read()).group(0)
+        with open(os.path.join(current_builder().spotify_path, "prefs")) as prefs:
+            prefs = re.search(r"app\.last-launched-version=\"(.*)\"", prefs.read())
+        if prefs:
+            return prefs.group(1)
+        executable = os.path.join(current_builder().spotify_path, "Spotify.exe")
+    if os.path.isfile(executable):
+        stat = os.stat(executable)
+        return f"fingerprint-{stat.st_size}-{stat.st_mtime_ns}"
+    ver = subprocess.run(["spotify", "--version"], stdout=subprocess.PIPE, timeout=30)
+    return ver.stdout.split()[2][:-1].decode()
+
+
+CSS_REPLACEMENTS = [
+    ("#1ed660", "var(--modspotify_sidebar_indicator_and_hover_button_bg)"),
+    ("#1ed760", "var(--modspotify_sidebar_indicator_and_hover_button_bg)"),
+    ("#1db954", "var(--modspotify_indicator_fg_and_button_bg)"),
+    ("#1df369", "var(--modspotify_indicator_fg_and_button_bg)"),
+    ("#1df269", "var(--modspotify_indicator_fg_and_button_bg)"),
+    ("#1cd85e", "var(--modspotify_indicator_fg_and_button_bg)"),
+    ("#1bd85e", "var(--modspotify_indicator_fg_and_button_bg)"),
+    ("#18ac4d", "var(--modspotify_selected_button)"),
+    ("#18ab4d", "var(--modspotify_selected_button)"),
+    ("#179443", "var(--modspotify_pressing_button_bg)"),
+    ("#14833b", "var(--modspotify_pressing_button_bg)"),
+    ("#282828", "var(--modspotify_main_bg)"),
+    ("#121212", "var(--modspotify_main_bg)"),
+    ("#999999", "var(--modspotify_main_bg)"),
+    ("#606060", "var(--modspotify_main_bg)"),
+    ("#181818", "var(--modspotify_sidebar_and_player_bg)"),
+    ("#000000", "var(--modspotify_sidebar_and_player_bg)"),
+    ("#3f3f3f", "var(--modspotify_scrollbar_fg_and_selected_row_bg)"),
+    ("#535353", "var(--modspotify_scrollbar_fg_and_selected_row_bg)"),
+    ("#333333", "var(--modspotify_scrollbar_fg_and_selected_row_bg)"),
+    ("#404040", "var(--modspotify_slider_bg)"),
+    ("#000011", "var(--modspotify_sidebar_and_player_bg)"),
+    ("#0a1a2d", "var(--modspotify_sidebar_and_player_bg)"),
+    ("#ffffff", "var(--modspotify_main_fg)"),
+    ("#f8f8f7", "var(--modspotify_pressing_fg)"),
+    ("#fcfcfc", "var(--modspotify_pressing_fg)"),
+    ("#d9d9d9", "var(--modspotify_pressing_fg)"),
+    ("#cdcdcd", "var(--modspotify_pressing_fg)"),
+    ("#e6e6e6", "var(--modspotify_pressing_fg)"),
+    ("#e5e5e5", "var(--modspotify_pressing_fg)"),
+    ("#adafb2", "var(--modspotify_secondary_fg)"),
+    ("#c8c8c8", "var(--modspotify_secondary_fg)"),
+    ("#a0a0a0", "var(--modspotify_secondary_fg)"),
+    ("#bec0bb", "var(--modspotify_secondary_fg)"),
+    ("#bababa", "var(--modspotify_secondary_fg)"),
+    ("#b3b3b3", "var(--modspotify_secondary_fg)"),
+    ("#c0c0c0", "var(--modspotify_secondary_fg)"),
+    ("#cccccc", "var(--modspotify_pressing_button_fg)"),
+    ("#ededed", "var(--modspotify_pressing_button_fg)"),
+    ("#4687d6", "var(--modspotify_miscellaneous_bg)"),
+    ("#2e77d0", "var(--modspotify_miscellaneous_hover_bg)"),
+    ("#ddd;", "var(--modspotify_pressing_button_fg);"),
+    ("#000;", "var(--modspotify_sidebar_and_player_bg);"),
+    ("#000 ", "var(--modspotify_sidebar_and_player_bg)"),
+    ("#333;", "var(--modspotify_scrollbar_fg_and_selected_row_bg);"),
+    ("#333 ", "var(--modspotify_scrollbar_fg_and_selected_row_bg)"),
+    ("#444;", "var(--modspotify_slider_bg);"),
+    ("#444 ", "var(--modspotify_slider_bg)"),
+    ("#fff;", "var(--modspotify_main_fg);"),
+    ("#fff ", "var(--modspotify_main_fg)"),
+    (" black;", " var(--modspotify_sidebar_and_player_bg);"),
+    (" black ", " var(--modspotify_sidebar_and_player_bg)"),
+    (" gray ", " var(--modspotify_main_bg)"),
+    (" gray;", " var(--modspotify_main_bg);"),
+    (" lightgray ", " var(--modspotify_pressing_button_fg)"),
+    (" lightgray;", " var(--modspotify_pressing_button_fg);"),
+    (" white;", " var(--modspotify_main_fg);"),
+    (" white ", " var(--modspotify_main_fg)"),
+    ("#fff", "var(--modspotify_main_fg)"),
+    ("#000", "var(--modspotify_sidebar_and_player_bg)"),
+    (r'rgba\(18, 18, 18, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
+    (r'rgba\(18, 19, 20, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
+    (r'rgba\(80, 55, 80, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
+    (r'rgba\(40, 40, 40, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
+    (r'rgba\(40,40,40,([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
+    (r'rgba\(24, 24, 24, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
+    (r'rgba\(18, 19, 20, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
+    (r'rgba\(179, 179, 179, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_secondary_fg),\1)"),
+    (r'rgba\(70, 135, 214, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_miscellaneous_bg),\1)"),
+    (r'rgba\(51,153,255,([\d.]+)\)', r"rgba(var(--modspotify_rgb_miscellaneous_hover_bg),\1)"),
+    (r'rgba\(30,50,100,([\d.]+)\)', r"rgba(var(--modspotify_rgb_miscellaneous_hover_bg),\1)"),
+    (r'rgba\(24, 24, 24, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
+    (r'rgba\(25,20,20,([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
+    (r'rgba\(160, 160, 160, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_pressing_button_fg),\1)"),
+    (r'rgba\(255, 255, 255, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_pressing_button_fg),\1)"),
+    (r'rgba\(0, 0, 0, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_cover_overlay_and_shadow),\1)"),
+    (r'rgba\(0,0,0,([\d.]+)\)', r"rgba(var(--modspotify_rgb_cover_overlay_and_shadow),\1)")
+]
+
+
+def factor_alternation(branches):
+    # Joins (first byte, rest of pattern) pairs into one alternation grouped by first byte, which lets the regex
+    # engine discard every branch but one group with a single comparison at each offset. Order within a group is
+    # kept, and branches in different groups can never match at the same offset, so priority is unchanged.
+    groups = {}
+    for first, rest in branches:
+        groups.setdefault(first, []).append(rest)
+    return b"|".join(re.escape(first) + b"(?:" + b"|".join(rests) + b")" for first, rests in groups.items())
+
+
+class ReplacementEngine:
+    # Applies an ordered table of (pattern, replacement) pairs with the same result as calling re.sub for each pair
+    # in turn, but in a single scan: earlier pairs win at the same offset just like they would sequentially. The two
+    # only differ when hits overlap, e.g. " white black;" where " white " eats the space " black;" needs, so text
+    # containing such an overlap takes the sequential route instead. The table is given as str and applied to bytes.
+    META_CHARACTERS = b"\\.^$*+?{}[]|()"
+
+    def __init__(self, replacements):
+        replacements = [(pattern.encode(), repl.encode()) for pattern, repl in replacements]
+        self.rules = [(re.compile(pattern), repl) for pattern, repl in replacements]
+        self.literals = {}
+        self.templates = {}
+        # Which rule every hit came from, only needed to count hits per rule when profiling
+        self.literal_rules = {}
+        self.group_rules = {}
+        branches = []
+        group = 1
+        for index, (pattern, repl) in enumerate(replacements):
+            if pattern[0] in self.META_CHARACTERS:
+                raise ValueError(f"Replacement pattern must start with a plain character: {pattern.decode()}")
+            if any(char in self.META_CHARACTERS for char in pattern):
+                # Real patterns get a capturing group to trace a hit back to them, and their \N references are
+                # renumbered to point into the combined pattern. Plain strings are looked up by the matched text.
+                rule = re.compile(pattern)
+                branches.append((pattern[:1], b"(" + pattern[1:] + b")"))
+                self.templates[group] = [int(part) + group if position % 2 else part
+                                         for position, part in enumerate(re.split(rb'\\(\d+)', repl))]
+                self.group_rules[group] = index
+                group += rule.groups + 1
+            else:
+                self.literals.setdefault(pattern, repl)
+                self.literal_rules.setdefault(pattern, index)
+                branches.append((pattern[:1], pattern[1:]))
+        self.scanner = re.compile(factor_alternation(branches))
+
+        overlaps = set()
+        for head in self.literals:
+            for tail in self.literals:
+                for i in range(1, len(head)):
+                    if tail.startswith(head[i:]):
+                        overlaps.add(head[:i] + tail)
+                    elif head[i:].startswith(tail):
+                        overlaps.add(head)
+        self.overlaps = re.compile(factor_alternation((overlap[:1], re.escape(overlap[1:]))
+                                                      for overlap in sorted(overlaps))) if overlaps else None
+
+    def _expand(self, match):
+        group = match.lastindex
+        if group is None:
+            return self.literals[match.group()]
+        return b"".join(part if isinstance(part, bytes) else match.group(part) for part in self.templates[group])
+
+    def sub(self, text, counts=None):
+        # counts, if given, maps rule indexes to the number of hits of that rule
+        if self.overlaps is not None and self.overlaps.search(text):
+            for index, (rule, repl) in enumerate(self.rules):
+                text, count = rule.subn(repl, text)
+                if counts is not None:
+                    counts[index] = counts.get(index, 0) + count
+            return text
+        if counts is None:
+            return self.scanner.sub(self._expand, text)
+
+        def expand(match):
+            index = self.rule_index(match)
+            counts[index] = counts.get(index, 0) + 1
+            return self._expand(match)
+
+        return self.scanner.sub(expand, text)
+
+    def rule_index(self, match):
+        if match.lastindex is None:
+            return self.literal_rules[match.group()]
+        return self.group_rules[match.lastindex]
+
+    def spans(self, text):
+        # (start, end, rule index) of every hit of the single pass. Text with overlapping hits gets the hits of the
+        # single pass too, which is close enough to tell what the table covers.
+        for match in self.scanner.finditer(text):
+            yield match.start(), match.end(), self.rule_index(match)
+
+
+CSS_ENGINE = None
+
+
+def css_engine():
+    # Compiled on first use rather than on import. Engines are never modified, so threads can share one.
+    global CSS_ENGINE
+
+    if CSS_ENGINE is None:
+        CSS_ENGINE = ReplacementEngine(CSS_REPLACEMENTS)
+    return CSS_ENGINE
 
 
 def convert_css(css_data):
-    replacements = [
-        ("#1ed660", "var(--modspotify_sidebar_indicator_and_hover_button_bg)"),
-        ("#1ed760", "var(--modspotify_sidebar_indicator_and_hover_button_bg)"),
-        ("#1db954", "var(--modspotify_indicator_fg_and_button_bg)"),
-        ("#1df369", "var(--modspotify_indicator_fg_and_button_bg)"),
-        ("#1df269", "var(--modspotify_indicator_fg_and_button_bg)"),
-        ("#1cd85e", "var(--modspotify_indicator_fg_and_button_bg)"),
-        ("#1bd85e", "var(--modspotify_indicator_fg_and_button_bg)"),
-        ("#18ac4d", "var(--modspotify_selected_button)"),
-        ("#18ab4d", "var(--modspotify_selected_button)"),
-        ("#179443", "var(--modspotify_pressing_button_bg)"),
-        ("#14833b", "var(--modspotify_pressing_button_bg)"),
-        ("#282828", "var(--modspotify_main_bg)"),
-        ("#121212", "var(--modspotify_main_bg)"),
-        ("#999999", "var(--modspotify_main_bg)"),
-        ("#606060", "var(--modspotify_main_bg)"),
-        ("#181818", "var(--modspotify_sidebar_and_player_bg)"),
-        ("#000000", "var(--modspotify_sidebar_and_player_bg)"),
-        ("#3f3f3f", "var(--modspotify_scrollbar_fg_and_selected_row_bg)"),
-        ("#535353", "var(--modspotify_scrollbar_fg_and_selected_row_bg)"),
-        ("#333333", "var(--modspotify_scrollbar_fg_and_selected_row_bg)"),
-        ("#404040", "var(--modspotify_slider_bg)"),
-        ("#000011", "var(--modspotify_sidebar_and_player_bg)"),
-        ("#0a1a2d", "var(--modspotify_sidebar_and_player_bg)"),
-        ("#ffffff", "var(--modspotify_main_fg)"),
-        ("#f8f8f7", "var(--modspotify_pressing_fg)"),
-        ("#fcfcfc", "var(--modspotify_pressing_fg)"),
-        ("#d9d9d9", "var(--modspotify_pressing_fg)"),
-        ("#cdcdcd", "var(--modspotify_pressing_fg)"),
-        ("#e6e6e6", "var(--modspotify_pressing_fg)"),
-        ("#e5e5e5", "var(--modspotify_pressing_fg)"),
-        ("#adafb2", "var(--modspotify_secondary_fg)"),
-        ("#c8c8c8", "var(--modspotify_secondary_fg)"),
-        ("#a0a0a0", "var(--modspotify_secondary_fg)"),
-        ("#bec0bb", "var(--modspotify_secondary_fg)"),
-        ("#bababa", "var(--modspotify_secondary_fg)"),
-        ("#b3b3b3", "var(--modspotify_secondary_fg)"),
-        ("#c0c0c0", "var(--modspotify_secondary_fg)"),
-        ("#cccccc", "var(--modspotify_pressing_button_fg)"),
-        ("#ededed", "var(--modspotify_pressing_button_fg)"),
-        ("#4687d6", "var(--modspotify_miscellaneous_bg)"),
-        ("#2e77d0", "var(--modspotify_miscellaneous_hover_bg)"),
-        ("#ddd;", "var(--modspotify_pressing_button_fg);"),
-        ("#000;", "var(--modspotify_sidebar_and_player_bg);"),
-        ("#000 ", "var(--modspotify_sidebar_and_player_bg)"),
-        ("#333;", "var(--modspotify_scrollbar_fg_and_selected_row_bg);"),
-        ("#333 ", "var(--modspotify_scrollbar_fg_and_selected_row_bg)"),
-        ("#444;", "var(--modspotify_slider_bg);"),
-        ("#444 ", "var(--modspotify_slider_bg)"),
-        ("#fff;", "var(--modspotify_main_fg);"),
-        ("#fff ", "var(--modspotify_main_fg)"),
-        (" black;", " var(--modspotify_sidebar_and_player_bg);"),
-        (" black ", " var(--modspotify_sidebar_and_player_bg)"),
-        (" gray ", " var(--modspotify_main_bg)"),
-        (" gray;", " var(--modspotify_main_bg);"),
-        (" lightgray ", " var(--modspotify_pressing_button_fg)"),
-        (" lightgray;", " var(--modspotify_pressing_button_fg);"),
-        (" white;", " var(--modspotify_main_fg);"),
-        (" white ", " var(--modspotify_main_fg)"),
-        ("#fff", "var(--modspotify_main_fg)"),
-        ("#000", "var(--modspotify_sidebar_and_player_bg)"),
-        (r'rgba\(18, 18, 18, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
-        (r'rgba\(18, 19, 20, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
-        (r'rgba\(80, 55, 80, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
-        (r'rgba\(40, 40, 40, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
-        (r'rgba\(40,40,40,([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
-        (r'rgba\(24, 24, 24, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
-        (r'rgba\(18, 19, 20, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
-        (r'rgba\(179, 179, 179, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_secondary_fg),\1)"),
-        (r'rgba\(70, 135, 214, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_miscellaneous_bg),\1)"),
-        (r'rgba\(51,153,255,([\d.]+)\)', r"rgba(var(--modspotify_rgb_miscellaneous_hover_bg),\1)"),
-        (r'rgba\(30,50,100,([\d.]+)\)', r"rgba(var(--modspotify_rgb_miscellaneous_hover_bg),\1)"),
-        (r'rgba\(24, 24, 24, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
-        (r'rgba\(25,20,20,([\d.]+)\)', r"rgba(var(--modspotify_rgb_sidebar_and_player_bg),\1)"),
-        (r'rgba\(160, 160, 160, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_pressing_button_fg),\1)"),
-        (r'rgba\(255, 255, 255, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_pressing_button_fg),\1)"),
-        (r'rgba\(0, 0, 0, ([\d.]+)\)', r"rgba(var(--modspotify_rgb_cover_overlay_and_shadow),\1)"),
-        (r'rgba\(0,0,0,([\d.]+)\)', r"rgba(var(--modspotify_rgb_cover_overlay_and_shadow),\1)")
-    ]
-    for old, new in replacements:
-        css_data = re.sub(old, new, css_data)
-
-    return css_data
+    if current_builder().profile is None:
+        return css_engine().sub(css_data)
+    counts = {}
+    css_data_converted = css_engine().sub(css_data, counts)
+    # The single pass has no per rule cost, so every rule is timed on its own against the same stylesheet. That is
+    # work a normal build doesn't do, so it's booked as overhead and left out of the stages around it.
+    overhead_start = time.perf_counter()
+    for index, (rule, repl) in enumerate(css_engine().rules):
+        start = time.perf_counter()
+        rule.subn(repl, css_data)
+        add_profile(["css_rules", rule.pattern.decode(), "seconds"], time.perf_counter() - start)
+        add_profile(["css_rules", rule.pattern.decode(), "matches"], counts.get(index, 0))
+    add_overhead(time.perf_counter() - overhead_start)
+    return css_data_converted
+
+
+def css_cache_name(version):
+    # Converted stylesheets only depend on the Spotify version and the replacement table, the colours themselves
+    # live in user.css
+    table_hash = hashlib.sha256(repr(CSS_REPLACEMENTS).encode()).hexdigest()[:16]
+    return re.sub(r'[^\w.-]', '_', version) + "-" + table_hash
+
+
+def cached_convert_css(css_data):
+    # Many archives ship identical stylesheets, so every conversion is remembered by content in the builder's memo
+    # for the rest of the build and, through its css_cache_dir, shared with the other workers and with later runs
+    builder = current_builder()
+    digest = hashlib.sha256(css_data).hexdigest()
+    cached_file = os.path.join(builder.css_cache_dir, digest + ".css") if builder.css_cache_dir is not None else None
+    converted = builder.css_memo.get(digest)
+    if converted is None and cached_file is not None:
+        # Builders in other threads share the cache directory, so the file can go away at any time
+        with contextlib.suppress(FileNotFoundError), open(cached_file, "rb") as css_file:
+            converted = css_file.read()
+    if converted is None:
+        builder.css_stats["converted"] += 1
+        converted = convert_css(css_data)
+        if cached_file is not None:
+            # Written under a unique name first so other workers never see a partial file
+            with tempfile.NamedTemporaryFile("wb", dir=builder.css_cache_dir, delete=False) as css_file:
+                css_file.write(converted)
+            os.replace(css_file.name, cached_file)
+        builder.css_memo[digest] = converted
+        return converted
+    builder.css_stats["reused"] += 1
+    builder.css_stats["bytes_saved"] += len(css_data)
+    builder.css_memo[digest] = converted
+    return converted
+
+
+def colour_patterns():
+    # The colour literals, and what declaration_values() walks: comments, strings and url() to skip and the
+    # characters that separate selectors, properties and values
+    global COLOUR_PATTERNS
+
+    if COLOUR_PATTERNS is None:
+        names = b"|".join(name.encode() for name in sorted(NAMED_COLOURS, key=len, reverse=True))
+        COLOUR_PATTERNS = (re.compile(rb'#[0-9a-fA-F]{3,8}(?![\w-])|rgba?\([^()]*\)|(?<![\w#.-])(?:' + names
+                                      + rb')(?![\w-])', re.IGNORECASE),
+                           re.compile(rb'/\*.*?\*/|"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|url\([^)]*\)|[{}:;]',
+                                      re.DOTALL | re.IGNORECASE))
+    return COLOUR_PATTERNS
+
+
+def declaration_values(css_data):
+    # Spans of the declaration values of a stylesheet, and of the comments, strings and url()s to leave out of them.
+    # A value runs from the first colon of a statement inside a block to the ; or } that ends it. A { ending it
+    # instead means the colon was part of a nested selector like a:hover in @media.
+    values, skipped = [], []
+    depth = 0
+    value_start = None
+    for match in colour_patterns()[1].finditer(css_data):
+        token = match.group()
+        if len(token) > 1:
+            skipped.append(match.span())
+        elif token == b":":
+            if depth and value_start is None:
+                value_start = match.end()
+        else:
+            if value_start is not None and token != b"{":
+                values.append((value_start, match.start()))
+            value_start = None
+            if token == b"{":
+                depth += 1
+            elif token == b"}":
+                depth = max(depth - 1, 0)
+    if value_start is not None:
+        # Blocks still open at the end of a stylesheet are closed by it
+        values.append((value_start, len(css_data)))
+    return values, skipped
+
+
+def in_spans(spans, position):
+    index = bisect.bisect_right(spans, (position, float("inf"))) - 1
+    return index >= 0 and position < spans[index][1]
+
+
+def parse_colour(literal):
+    # (r, g, b) of a colour literal, None if it isn't a plain colour
+    literal = literal.lower()
+    if literal.startswith("#"):
+        digits = literal[1:]
+        if len(digits) in (3, 4):
+            digits = "".join(digit * 2 for digit in digits)
+        return tuple(int(digits[i:i + 2], 16) for i in (0, 2, 4))
+    if literal.startswith("rgb"):
+        values = re.findall(r'([\d.]+)(%?)', literal)
+        if len(values) < 3:
+            return None
+        return tuple(min(255, round(float(value) * (2.55 if percent else 1))) for value, percent in values[:3])
+    if literal in NAMED_COLOURS:
+        return parse_colour(NAMED_COLOURS[literal])
+    return None
+
+
+def scan_colours(css_data):
+    # (literal, line, column, role) of every colour in a stylesheet, where role is the one convert_css replaces it
+    # with or None
+    engine = css_engine()
+    roles = [re.search(r'--modspotify_(?:rgb_)?(\w+)', repl).group(1) for _, repl in CSS_REPLACEMENTS]
+    starts, ends, hit_roles = [], [], []
+    for start, end, index in engine.spans(css_data):
+        starts.append(start)
+        ends.append(end)
+        hit_roles.append(roles[index])
+    line_starts = [0] + [match.end() for match in re.finditer(b"\n", css_data)]
+    values, skipped = declaration_values(css_data)
+    colours = []
+    for match in colour_patterns()[0].finditer(css_data):
+        literal = match.group().decode()
+        if literal.startswith("#") and len(literal) not in (4, 5, 7, 9):
+            continue
+        # Only values count, not selectors like #fade, fragments like url(#fade) or comments
+        start = match.start()
+        if not in_spans(values, start) or in_spans(skipped, start):
+            continue
+        hit = bisect.bisect_right(starts, start) - 1
+        role = hit_roles[hit] if hit >= 0 and start < ends[hit] else None
+        line = bisect.bisect_right(line_starts, start)
+        colours.append((literal, line, start - line_starts[line - 1] + 1, role))
+    return colours
+
+
+def nearest_roles(colours):
+    # (role, distance) of the default colour closest to each (r, g, b), all at once with numpy when it's installed
+    roles = list(default_colors)
+    palette = [tuple(int(value) for value in hex_to_rgb(default_colors[role]).split(",")) for role in roles]
+    if not colours:
+        return []
+    try:
+        # Optional, and only imported here so importing ricetify stays cheap
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy is not None:
+        differences = numpy.array(colours, dtype=float)[:, None, :] - numpy.array(palette, dtype=float)[None, :, :]
+        distances = numpy.sqrt((differences ** 2).sum(axis=2))
+        closest = distances.argmin(axis=1)
+        return [(roles[index], float(distances[row, index])) for row, index in enumerate(closest)]
+    nearest = []
+    for colour in colours:
+        distances = [sum((a - b) ** 2 for a, b in zip(colour, rgb)) ** 0.5 for rgb in palette]
+        index = distances.index(min(distances))
+        nearest.append((roles[index], distances[index]))
+    return nearest
+
+
+def analyze_colours(backup_dir, manifest):
+    # Every colour literal in the stylesheets of the backup with how often and where it's used, which roles
+    # convert_css gives it and the closest default colour. Stylesheets shipped by several archives are scanned once.
+    scans = {}
+    colours = {}
+    for filename in sorted(manifest):
+        with zipfile.ZipFile(os.path.join(backup_dir, filename)) as spa:
+            for name in spa.namelist():
+                if not name.endswith(".css") or name == "css/user.css":
+                    continue
+                css_data = spa.read(name)
+                digest = hashlib.sha256(css_data).digest()
+                if digest not in scans:
+                    scans[digest] = scan_colours(css_data)
+                for literal, line, column, role in scans[digest]:
+                    entry = colours.setdefault(literal, {"count": 0, "mapped": 0, "roles": {}, "locations": []})
+                    entry["count"] += 1
+                    if role is not None:
+                        entry["mapped"] += 1
+                        entry["roles"][role] = entry["roles"].get(role, 0) + 1
+                    entry["locations"].append(f"{filename}/{name}:{line}:{column}")
+    debug_print(f"Scanned {len(scans)} distinct stylesheets", 1)
+
+    parsed = [(literal, parse_colour(literal)) for literal in sorted(colours)]
+    parsed = [(literal, rgb) for literal, rgb in parsed if rgb is not None]
+    for (literal, rgb), (role, distance) in zip(parsed, nearest_roles([rgb for _, rgb in parsed])):
+        colours[literal]["rgb"] = list(rgb)
+        colours[literal]["nearest"] = {"role": role, "distance": round(distance, 1)}
+    return colours
+
+
+def print_colour_report(colours, verbosity):
+    # Unmapped colours first, most used first
+    rows = sorted(colours.items(), key=lambda item: (item[1]["mapped"] == item[1]["count"], -item[1]["count"],
+                                                     item[0]))
+    print(f"{'Colour':<32}{'Uses':>6}{'Mapped':>8}  Role")
+    for literal, entry in rows:
+        role = ", ".join(sorted(entry["roles"])) if entry["mapped"] else "unmapped"
+        if entry["mapped"] < entry["count"] and "nearest" in entry:
+            role += f" (nearest {entry['nearest']['role']}, distance {entry['nearest']['distance']:g})"
+        print(f"{literal:<32}{entry['count']:>6}{entry['mapped']:>8}  {role}")
+        if verbosity >= 1:
+            locations = entry["locations"] if verbosity >= 2 else entry["locations"][:3]
+            for location in locations:
+                print(f"    {location}")
+            if len(locations) < len(entry["locations"]):
+                print(f"    ... {len(entry['locations']) - len(locations)} more")
+    unmapped = [entry for entry in colours.values() if entry["mapped"] < entry["count"]]
+    print(f"{len(colours)} colours, {len(unmapped)} not always mapped "
+          f"({sum(entry['count'] - entry['mapped'] for entry in unmapped)} unmapped uses)")
 
 
 def generate_color_vars(colours):
@@ -167,219 +636,664 @@ def generate_color_vars(colours):
     return css_vars
 
 
-def inject_css(folder_path, user_css):
-    if 'Colours' in CONFIG:
-        colours = CONFIG['Colours']
+def generate_user_css(user_css, colours=None):
+    config = current_builder().config
+    if colours is not None:
+        pass
+    elif 'Colours' in config:
+        colours = config['Colours']
     else:
         colours = default_colors
 
-    css_data = generate_color_vars(colours)
+    css_data = generate_color_vars(colours).encode()
 
     if user_css:
-        with open(user_css) as user_css:
+        with open(user_css, "rb") as user_css:
             css_data += user_css.read()
 
-    with open(os.path.join(folder_path, "css/user.css"), "w") as css_file:
-        css_file.write(css_data)
+    return css_data
+
+
+def inject_css(folder_path, user_css):
+    with open(os.path.join(folder_path, "css/user.css"), "wb") as css_file:
+        css_file.write(generate_user_css(user_css))
+
+
+def rewrite_file(path, transform):
+    # Runs transform over a read only memory map of path and writes its result back. Files are handled as bytes
+    # throughout, so nothing depends on the locale and only the rewritten copy is ever held in memory.
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            data = transform(b"")
+        else:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as source:
+                data = transform(source)
+    with open(path, "wb") as file:
+        file.write(data)
+    return size, len(data)
 
 
 def process_css(folder_path):
     css_dir = os.path.join(folder_path, "css")
-    processed_glue = None
     if os.path.isdir(css_dir):
         for css in glob.glob(os.path.join(css_dir, "*.css")):
-            css_filename = os.path.basename(css)
-            debug_print(f"\t\t{css_filename}", 3)
-            if css_filename == "glue.css" and processed_glue is not None:
-                css_data = processed_glue
-            else:
-                with open(css) as css_file:
-                    css_data = convert_css(css_file.read())
-                if css_filename == "glue.css":
-                    processed_glue = css_data
-            with open(css, "w") as css_file:
-                css_file.write(css_data)
+            debug_print(f"\t\t{os.path.basename(css)}", 3)
+            profile_io(os.path.basename(folder_path), *rewrite_file(css, cached_convert_css))
 
 
 def process_html(folder_path, extensions):
+    filename = os.path.basename(folder_path)
     for html in glob.glob(os.path.join(folder_path, "*.html")):
-        html_filename = os.path.basename(html)
-        debug_print(f"\t\t{html_filename}", 3)
-        with open(html) as html_file:
-            html_data = html_file.read()
-        html_data = html_data.replace('</head>', '<link rel="stylesheet" class="userCSS" href="css/user.css"></head>')
-        if 'zlink' in folder_path:
-            html_data = html_data.replace('</body>', '<script src="/jquery-3.3.1.min.js"></script></body>')
-            for ext in (extensions if extensions is not None else []):
-                html_data = html_data.replace('</body>', f'<script src="/{os.path.basename(ext)}"></script></body>')
-        with open(html, "w") as html_file:
-            html_file.write(html_data)
-
-
-def replace_in_file(filename, js_filename, pattern, repl):
-    file_path = os.path.join(TEMP_DIR_PATH, filename, js_filename)
-    with open(file_path) as file:
-        file_data = file.read()
-    with open(file_path, "w") as file:
-        file.write(re.sub(pattern, repl, file_data))
-
-
-def inject_js(filename, js_filename):
-    shutil.copy2(os.path.join(RICETIFY_FOLDER, js_filename), os.path.join(TEMP_DIR_PATH, filename))
-
-
-def mod_js(extensions):
-    js_options = CONFIG['Javascript']
+        debug_print(f"\t\t{os.path.basename(html)}", 3)
+        profile_io(filename, *rewrite_file(html, lambda html_data: modify_html(html_data, filename, extensions)))
+
+
+def modify_html(html_data, filename, extensions):
+    # html_data may be a memory map, which has no replace()
+    html_data = bytes(html_data).replace(b'</head>',
+                                         b'<link rel="stylesheet" class="userCSS" href="css/user.css"></head>')
+    if 'zlink' in filename:
+        html_data = html_data.replace(b'</body>', b'<script src="/jquery-3.3.1.min.js"></script></body>')
+        for ext in (extensions if extensions is not None else []):
+            script = f'<script src="/{os.path.basename(ext)}"></script></body>'.encode()
+            html_data = html_data.replace(b'</body>', script)
+    return html_data
+
+
+def literal_prefix(pattern):
+    # The literal text every match of pattern starts with, read up to its first regex operator. Alternations and
+    # optional groups make that hard to tell, so those patterns get no prefix at all.
+    if re.search(r'(?<!\\)(?:\\\\)*(?:\||\)[*?{])', pattern):
+        return ""
+    prefix = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == "(" and not pattern.startswith("(?", index) or char == ")":
+            index += 1
+            continue
+        if char == "\\" and index + 1 < len(pattern) and not pattern[index + 1].isalnum():
+            char = pattern[index + 1]
+            index += 2
+        elif char in "\\.^$*+?{}[]()|":
+            break
+        else:
+            index += 1
+        if pattern[index:index + 1] in ("*", "?", "{"):
+            break
+        prefix.append(char)
+        if pattern[index:index + 1] == "+":
+            break
+    return "".join(prefix)
+
+
+class JsRule:
+    # One JS patch. Every match has to start with the literal anchor, so the regex only runs where str.find located
+    # the anchor and may only look window characters ahead, which keeps patterns like .*? linear on the huge one line
+    # bundles. Patterns without a usable anchor fall back to a plain re.subn. Rules are written as str and applied
+    # to bytes.
+    def __init__(self, pattern, repl, anchor=None, window=JS_PATCH_WINDOW):
+        self.pattern = pattern
+        self.repl = repl
+        self.anchor = (literal_prefix(pattern) if anchor is None else anchor).encode()
+        self.window = window
+        self.regex = re.compile(pattern.encode())
+        self.template = repl.encode()
+
+    def __repr__(self):
+        return f"JsRule({self.pattern!r}, {self.repl!r}, {self.anchor!r}, {self.window})"
+
+    def subn(self, text):
+        if not self.anchor:
+            return self.regex.subn(self.template, text)
+        pieces = []
+        count = 0
+        end = 0
+        position = text.find(self.anchor)
+        while position != -1:
+            match = self.regex.match(text, position, position + self.window)
+            if match is None:
+                position = text.find(self.anchor, position + 1)
+                continue
+            pieces.append(text[end:position])
+            pieces.append(match.expand(self.template))
+            count += 1
+            end = match.end()
+            position = text.find(self.anchor, end)
+        pieces.append(text[end:])
+        return b"".join(pieces), count
+
+
+class PatchPlan:
+    # Collects every JS patch and injected script up front so each bundle is read, patched in memory and written
+    # exactly once, however many patches target it.
+    def __init__(self):
+        self.patches = {}
+        self.injections = {}
+
+    def replace(self, filename, js_filename, pattern, repl, anchor=None, window=JS_PATCH_WINDOW):
+        self.patches.setdefault((filename, js_filename), []).append(JsRule(pattern, repl, anchor, window))
+
+    def inject(self, filename, js_filename):
+        self.injections.setdefault(filename, []).append(os.path.join(current_builder().ricetify_folder, js_filename))
+
+    def apply(self, folder_path):
+        filename = os.path.basename(folder_path)
+        for js_filename in self.js_files(filename):
+            file_path = os.path.join(folder_path, js_filename)
+            if not os.path.isfile(file_path):
+                print(f"Warning: {filename}/{js_filename} does not exist, skipped its patches")
+                continue
+            profile_io(filename, *rewrite_file(file_path, lambda file_data: self.patch(filename, js_filename,
+                                                                                         file_data)))
+        for js_path in self.injections.get(filename, []):
+            shutil.copy2(js_path, folder_path)
+
+    def filenames(self):
+        return {filename for filename, _ in self.patches} | set(self.injections)
+
+    def patch(self, filename, js_filename, file_data):
+        for rule in self.patches[(filename, js_filename)]:
+            start = time.perf_counter()
+            file_data, count = rule.subn(file_data)
+            name = f"{filename}/{js_filename}: {rule.pattern}"
+            add_profile(["js_patches", name, "seconds"], time.perf_counter() - start)
+            add_profile(["js_patches", name, "matches"], count)
+            report_patch(filename, js_filename, rule.pattern, count)
+        return file_data
+
+    def js_files(self, filename):
+        return [js_filename for spa, js_filename in self.patches if spa == filename]
+
+
+def report_patch(filename, js_filename, pattern, count):
+    if count == 0:
+        print(f"Warning: patch did not match in {filename}/{js_filename}: {pattern}")
+    else:
+        debug_print(f"\t{filename}/{js_filename}: {count} match(es) for {pattern}", 2)
+
+
+def copy_raw_member(src, dst, info):
+    # zipfile has no public way to copy a member without inflating and deflating it again, so the compressed bytes
+    # are read straight from behind the local header in the source and written behind a fresh one in the output
+    src.fp.seek(info.header_offset)
+    header = src.fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    src.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+    raw = src.fp.read(info.compress_size)
+
+    zinfo = copy.copy(info)
+    # Sizes and CRC are known up front, so no data descriptor follows the data
+    zinfo.flag_bits &= ~0x08
+    zinfo.header_offset = dst.fp.tell()
+    dst.fp.write(zinfo.FileHeader())
+    dst.fp.write(raw)
+    dst.start_dir = dst.fp.tell()
+    dst.filelist.append(zinfo)
+    dst.NameToInfo[zinfo.filename] = zinfo
+    dst._didModify = True
+
+
+def stream_spa(file, output_file, plan, extensions, user_css):
+    # Builds the output archive straight from the backup without extracting it: css, html and patched js members
+    # are rewritten in memory and everything else is copied over still compressed
+    filename = os.path.basename(file)
+    debug_print(f"\tStreaming: {filename}", 2)
+
+    js_files = plan.js_files(filename)
+    with zipfile.ZipFile(file, "r") as src, zipfile.ZipFile(output_file + ".zip", "w", zipfile.ZIP_DEFLATED) as dst:
+        for info in src.infolist():
+            name = info.filename
+            data = None
+            if info.is_dir():
+                pass
+            elif name == "css/user.css":
+                continue
+            elif os.path.dirname(name) == "css" and name.endswith(".css"):
+                debug_print(f"\t\t{os.path.basename(name)}", 3)
+                source = src.read(info)
+                with profile_stage("process_css", filename):
+                    data = cached_convert_css(source)
+            elif "/" not in name and name.endswith(".html"):
+                debug_print(f"\t\t{name}", 3)
+                source = src.read(info)
+                with profile_stage("process_html", filename):
+                    data = modify_html(source, filename, extensions)
+            elif name in js_files:
+                js_files.remove(name)
+                source = src.read(info)
+                with profile_stage("mod_js", filename):
+                    data = plan.patch(filename, name, source)
+
+            if data is None:
+                copy_raw_member(src, dst, info)
+                add_profile(["files", filename, "bytes_copied"], info.compress_size)
+            else:
+                zinfo = zipfile.ZipInfo(name, info.date_time)
+                zinfo.external_attr = info.external_attr
+                dst.writestr(zinfo, data, zipfile.ZIP_DEFLATED)
+                profile_io(filename, len(source), len(data))
+
+        zinfo = zipfile.ZipInfo("css/user.css")
+        zinfo.external_attr = 0o644 << 16
+        dst.writestr(zinfo, generate_user_css(user_css), zipfile.ZIP_DEFLATED)
+        for js_path in plan.injections.get(filename, []):
+            dst.write(js_path, os.path.basename(js_path))
+        for js_filename in js_files:
+            print(f"Warning: {filename}/{js_filename} does not exist, skipped its patches")
+    return install_archive(output_file + ".zip", output_file)
+
+
+def mod_js(plan, extensions):
+    js_options = current_builder().config['Javascript']
     if js_options.getboolean('enabled_dev_tools'):
         debug_print("\tEnabled dev tools", 1)
-        replace_in_file("settings.spa", "settings.bundle.js", r"(const isEmployee = ).*;", r"\1true;")
+        plan.replace("settings.spa", "settings.bundle.js", r"(const isEmployee = ).*;", r"\1true;")
     if js_options.getboolean('enabled_home'):
         debug_print("\tEnabled home", 1)
-        replace_in_file('zlink.spa', 'zlink.bundle.js', r"this\._initialState\.isHomeEnabled", r"true")
-        replace_in_file('zlink.spa', 'zlink.bundle.js', r"isHomeEnabled(\?void 0:_flowControl)", r"true\1")
+        plan.replace('zlink.spa', 'zlink.bundle.js', r"this\._initialState\.isHomeEnabled", r"true")
+        plan.replace('zlink.spa', 'zlink.bundle.js', r"isHomeEnabled(\?void 0:_flowControl)", r"true\1")
     if js_options.getboolean('enabled_radio'):
         debug_print("\tEnabled radio", 1)
-        replace_in_file('zlink.spa', 'zlink.bundle.js', r'\(0,_productState\.hasValue\)\("radio","1"\)', r"true")
+        plan.replace('zlink.spa', 'zlink.bundle.js', r'\(0,_productState\.hasValue\)\("radio","1"\)', r"true")
     mod_options = r''
     if js_options.getboolean('enabled_lyrics') and js_options.getboolean('lyrics_always_show'):
         debug_print("\tEnabled lyrics and always show button", 1)
-        replace_in_file('lyrics.spa', 'lyrics.bundle.js', r'(const anyAbLyricsEnabled = )', r'\1true || ')
-        replace_in_file('zlink.spa', 'zlink.bundle.js', r'(lyricsEnabled\()trackHasLyrics&&\(.*?\)', r'\1true')
+        plan.replace('lyrics.spa', 'lyrics.bundle.js', r'(const anyAbLyricsEnabled = )', r'\1true || ')
+        plan.replace('zlink.spa', 'zlink.bundle.js', r'(lyricsEnabled\()trackHasLyrics&&\(.*?\)', r'\1true')
         mod_options = r'trackControllerOpts.noService = false;\n'
     elif js_options.getboolean('enabled_lyrics'):
         debug_print("\tEnabled lyrics", 1)
-        replace_in_file('lyrics.spa', 'lyrics.bundle.js', r'(const anyAbLyricsEnabled = )', r'\1true || ')
-        replace_in_file('zlink.spa', 'zlink.bundle.js', r'(lyricsEnabled\(trackHasLyrics)&&\(.*?\)', r'\1')
+        plan.replace('lyrics.spa', 'lyrics.bundle.js', r'(const anyAbLyricsEnabled = )', r'\1true || ')
+        plan.replace('zlink.spa', 'zlink.bundle.js', r'(lyricsEnabled\(trackHasLyrics)&&\(.*?\)', r'\1')
         mod_options = r'trackControllerOpts.noService = false;\n'
     elif js_options.getboolean('lyrics_always_show'):
         debug_print("\tEnabled always show lyrics button", 1)
-        replace_in_file('zlink.spa', 'zlink.bundle.js', r'(lyricsEnabled\()trackHasLyrics&&\(.*\)', r'\1true')
+        plan.replace('zlink.spa', 'zlink.bundle.js', r'(lyricsEnabled\()trackHasLyrics&&\(.*\)', r'\1true')
     if mod_options != "":
-        replace_in_file('lyrics.spa', 'lyrics.bundle.js', r'(trackController\.init\(trackControllerOpts\))',
-                        mod_options + r"\1")
-
-    inject_js("zlink.spa", "jquery-3.3.1.min.js")
-    replace_in_file('zlink.spa', 'zlink.bundle.js', r'PlayerUI\.prototype\.setup=function\(\){',
-                    'PlayerUI.prototype.setup=function(){chrome.player={};chrome.player.seek=(p)=>{if('
-                    'p<=1)p=Math.round(p*(chrome.playerData?chrome.playerData.track.metadata.duration:0));this.seek('
-                    'p)};chrome.player.getProgressMs=()=>this.progressbar.getRealValue('
-                    ');chrome.player.getProgressPercent=()=>this.progressbar.getPercentage('
-                    ');chrome.player.getDuration=()=>this.progressbar.getMaxValue();chrome.player.skipForward=('
-                    'a=15e3)=>chrome.player.seek(chrome.player.getProgressMs()+a);chrome.player.skipBack=('
-                    'a=15e3)=>chrome.player.seek(chrome.player.getProgressMs()-a);chrome.player.setVolume=('
-                    'v)=>this.changeVolume(v, false);chrome.player.increaseVolume=()=>this.increaseVolume('
-                    ');chrome.player.decreaseVolume=()=>this.decreaseVolume();chrome.player.getVolume=('
-                    ')=>this.volumebar.getValue();chrome.player.next=()=>this._doSkipToNext();chrome.player.back=('
-                    ')=>this._doSkipToPrevious();chrome.player.togglePlay=()=>this._doTogglePlay('
-                    ');chrome.player.play=()=>{eventDispatcher.dispatchEvent(new Event('
-                    'Event.TYPES.PLAYER_RESUME))};chrome.player.pause=()=>{eventDispatcher.dispatchEvent(new Event('
-                    'Event.TYPES.PLAYER_PAUSE))};chrome.player.isPlaying=()=>this.progressbar.isPlaying('
-                    ');chrome.player.toggleShuffle=()=>this.toggleShuffle();chrome.player.getShuffle=('
-                    ')=>this.shuffle();chrome.player.setShuffle=(b)=>{this.shuffle(b)};chrome.player.toggleRepeat=('
-                    ')=>this.toggleRepeat();chrome.player.getRepeat=()=>this.repeat();chrome.player.setRepeat=(r)=>{'
-                    'this.repeat(r)};chrome.player.getMute=()=>this.mute();chrome.player.toggleMute=('
-                    ')=>this._doToggleMute();chrome.player.setMute=(b)=>{this.volumeEnabled()&&this.changeVolume('
-                    'this._unmutedVolume,b)};chrome.player.thumbUp=()=>this.thumbUp();chrome.player.getThumbUp=('
-                    ')=>this.trackThumbedUp();chrome.player.thumbDown=()=>this.thumbDown('
-                    ');chrome.player.getThumbDown=()=>this.trackThumbedDown();chrome.player.formatTime=('
-                    'ms)=>this._formatTime(ms);chrome.player.eventListeners={};chrome.player.addEventListener=(type,'
-                    'callback)=>{if(!(type in chrome.player.eventListeners)){chrome.player.eventListeners[type]=['
-                    ']}chrome.player.eventListeners[type].push(callback)};chrome.player.removeEventListener=(type,'
-                    'callback)=>{if(!(type in chrome.player.eventListeners)){return}var '
-                    'stack=chrome.player.eventListeners[type];for(var i=0,l=stack.length;i<l;i+=1){if(stack['
-                    'i]===callback){stack.splice(i,1);return}}};chrome.player.dispatchEvent=(event)=>{if(!(event.type '
-                    'in chrome.player.eventListeners)){return true}var stack=chrome.player.eventListeners['
-                    'event.type];for(var i=0,l=stack.length;i<l;i+=1){stack[i](event)}return!event.defaultPrevented};')
+        plan.replace('lyrics.spa', 'lyrics.bundle.js', r'(trackController\.init\(trackControllerOpts\))',
+                     mod_options + r"\1")
+
+    plan.inject("zlink.spa", "jquery-3.3.1.min.js")
+    plan.replace('zlink.spa', 'zlink.bundle.js', r'PlayerUI\.prototype\.setup=function\(\){',
+                 'PlayerUI.prototype.setup=function(){chrome.player={};chrome.player.seek=(p)=>{if('
+                 'p<=1)p=Math.round(p*(chrome.playerData?chrome.playerData.track.metadata.duration:0));this.seek('
+                 'p)};chrome.player.getProgressMs=()=>this.progressbar.getRealValue('
+                 ');chrome.player.getProgressPercent=()=>this.progressbar.getPercentage('
+                 ');chrome.player.getDuration=()=>this.progressbar.getMaxValue();chrome.player.skipForward=('
+                 'a=15e3)=>chrome.player.seek(chrome.player.getProgressMs()+a);chrome.player.skipBack=('
+                 'a=15e3)=>chrome.player.seek(chrome.player.getProgressMs()-a);chrome.player.setVolume=('
+                 'v)=>this.changeVolume(v, false);chrome.player.increaseVolume=()=>this.increaseVolume('
+                 ');chrome.player.decreaseVolume=()=>this.decreaseVolume();chrome.player.getVolume=('
+                 ')=>this.volumebar.getValue();chrome.player.next=()=>this._doSkipToNext();chrome.player.back=('
+                 ')=>this._doSkipToPrevious();chrome.player.togglePlay=()=>this._doTogglePlay('
+                 ');chrome.player.play=()=>{eventDispatcher.dispatchEvent(new Event('
+                 'Event.TYPES.PLAYER_RESUME))};chrome.player.pause=()=>{eventDispatcher.dispatchEvent(new Event('
+                 'Event.TYPES.PLAYER_PAUSE))};chrome.player.isPlaying=()=>this.progressbar.isPlaying('
+                 ');chrome.player.toggleShuffle=()=>this.toggleShuffle();chrome.player.getShuffle=('
+                 ')=>this.shuffle();chrome.player.setShuffle=(b)=>{this.shuffle(b)};chrome.player.toggleRepeat=('
+                 ')=>this.toggleRepeat();chrome.player.getRepeat=()=>this.repeat();chrome.player.setRepeat=(r)=>{'
+                 'this.repeat(r)};chrome.player.getMute=()=>this.mute();chrome.player.toggleMute=('
+                 ')=>this._doToggleMute();chrome.player.setMute=(b)=>{this.volumeEnabled()&&this.changeVolume('
+                 'this._unmutedVolume,b)};chrome.player.thumbUp=()=>this.thumbUp();chrome.player.getThumbUp=('
+                 ')=>this.trackThumbedUp();chrome.player.thumbDown=()=>this.thumbDown('
+                 ');chrome.player.getThumbDown=()=>this.trackThumbedDown();chrome.player.formatTime=('
+                 'ms)=>this._formatTime(ms);chrome.player.eventListeners={};chrome.player.addEventListener=(type,'
+                 'callback)=>{if(!(type in chrome.player.eventListeners)){chrome.player.eventListeners[type]=['
+                 ']}chrome.player.eventListeners[type].push(callback)};chrome.player.removeEventListener=(type,'
+                 'callback)=>{if(!(type in chrome.player.eventListeners)){return}var '
+                 'stack=chrome.player.eventListeners[type];for(var i=0,l=stack.length;i<l;i+=1){if(stack['
+                 'i]===callback){stack.splice(i,1);return}}};chrome.player.dispatchEvent=(event)=>{if(!(event.type '
+                 'in chrome.player.eventListeners)){return true}var stack=chrome.player.eventListeners['
+                 'event.type];for(var i=0,l=stack.length;i<l;i+=1){stack[i](event)}return!event.defaultPrevented};')
     # Leak track meta data, player state, current playlist to chrome.playerData
-    replace_in_file('zlink.spa', 'zlink.bundle.js', r'const metadata=data\.track\.metadata;',
-                    'const metadata=data.track.metadata;chrome.playerData=data;')
+    plan.replace('zlink.spa', 'zlink.bundle.js', r'const metadata=data\.track\.metadata;',
+                 'const metadata=data.track.metadata;chrome.playerData=data;')
     # Leak localStorage and showNotification
-    replace_in_file('zlink.spa', 'zlink.bundle.js', r'_localStorage2\.default\.get\(SETTINGS_KEY_AD\);',
-                    '_localStorage2.default.get(SETTINGS_KEY_AD);chrome.localStorage=_localStorage2.default;'
-                    'chrome.showNotification = text => {_eventDispatcher2.default.dispatchEvent(new _event2.default('
-                    '_event2.default.TYPES.SHOW_NOTIFICATION_BUBBLE, {i18n: text}))};')
+    plan.replace('zlink.spa', 'zlink.bundle.js', r'_localStorage2\.default\.get\(SETTINGS_KEY_AD\);',
+                 '_localStorage2.default.get(SETTINGS_KEY_AD);chrome.localStorage=_localStorage2.default;'
+                 'chrome.showNotification = text => {_eventDispatcher2.default.dispatchEvent(new _event2.default('
+                 '_event2.default.TYPES.SHOW_NOTIFICATION_BUBBLE, {i18n: text}))};')
     # Leak bridgeAPI
-    replace_in_file('zlink.spa', 'zlink.bundle.js', r'BuddyList\.prototype\.setup=function\(\){',
-                    'BuddyList.prototype.setup=function(){chrome.bridgeAPI = _bridge;')
+    plan.replace('zlink.spa', 'zlink.bundle.js', r'BuddyList\.prototype\.setup=function\(\){',
+                 'BuddyList.prototype.setup=function(){chrome.bridgeAPI = _bridge;')
     # Leak audio data fetcher to chrome.getAudioData
-    replace_in_file('zlink.spa', 'zlink.bundle.js', r'PlayerHelper\.prototype\._player=null',
-                    'var uriToId=u=>{var t=u.match(/^spotify:track:(.*)/);if(!t||t.length<2)return false;'
-                    'else return t[1]};chrome.getAudioData=(callback, uri)=>{uri=uri||chrome.playerData.track.uri;if('
-                    'typeof(callback)!=="function"){console.log("chrome.getAudioData: callback has to be a function");'
-                    'return;};var id=uriToId(uri);if(id)cosmos.resolver.get(`hm://audio-attributes/v1/audio-analysis/'
-                    '${id}`, (e,p)=>{if(e){console.log(e);callback(null);return;}if('
-                    'p._status===200&&p._body&&p._body!==""){var data=JSON.parse(p._body);data.uri=uri;callback(data);'
-                    '}else callback(null)})};new Player(cosmos.resolver,"spotify:internal:queue","queue","1.0.0")'
-                    '.subscribeToQueue((e,r)=>{if(e){console.log(e);return;}chrome.queue=r.getJSONBody();});'
-                    'PlayerHelper.prototype._player=null')
-    replace_in_file('zlink.spa', 'zlink.bundle.js', r'const Adaptor=function\(bridge,cosmos\)\{',
-                    'const Adaptor=function(bridge,cosmos){chrome.libURI = liburi;chrome.addToQueue=(uri,callback)=>'
-                    '{uri=liburi.from(uri);if(uri.type===liburi.Type.ALBUM){this.getAlbumTracks(uri,(err,tracks)=>'
-                    '{if(err){console.log("chrome.addToQueue",err);return};this.queueTracks(tracks,callback)})}else '
-                    'if(uri.type===liburi.Type.TRACK||uri.type===liburi.Type.EPISODE){this.queueTracks([uri],callback)}'
-                    'else{console.log("chrome.addToQueue: Only Track and Album URIs are accepted")}};'
-                    'chrome.removeFromQueue=(uri,callback)=>{if(chrome.queue){var indices=[],uriObj=liburi.from(uri);'
-                    'if(uriObj.type===liburi.Type.ALBUM){this.getAlbumTracks(uriObj,(err,tracks)=>{if(err){'
-                    'console.log(err);return}tracks.forEach(t=>chrome.queue.next_tracks.forEach((nt,index)=>'
-                    't==nt.uri&&indices.push(index)))})}else if(uriObj.type===liburi.Type.TRACK||'
-                    'uriObj.type===liburi.Type.EPISODE){chrome.queue.next_tracks.forEach((track,index)=>'
-                    'track.uri==uri&&indices.push(index))}else{console.log("chrome.removeFromQueue: Only Album, '
-                    'Track and Episode URIs are accepted")}indices=indices.reduce((a,b)=>{if(a.indexOf(b)<0){a.push('
-                    'b)}return a},[]);this.removeTracksFromQueue(indices,callback)}}; ')
+    plan.replace('zlink.spa', 'zlink.bundle.js', r'PlayerHelper\.prototype\._player=null',
+                 'var uriToId=u=>{var t=u.match(/^spotify:track:(.*)/);if(!t||t.length<2)return false;'
+                 'else return t[1]};chrome.getAudioData=(callback, uri)=>{uri=uri||chrome.playerData.track.uri;if('
+                 'typeof(callback)!=="function"){console.log("chrome.getAudioData: callback has to be a function");'
+                 'return;};var id=uriToId(uri);if(id)cosmos.resolver.get(`hm://audio-attributes/v1/audio-analysis/'
+                 '${id}`, (e,p)=>{if(e){console.log(e);callback(null);return;}if('
+                 'p._status===200&&p._body&&p._body!==""){var data=JSON.parse(p._body);data.uri=uri;callback(data);'
+                 '}else callback(null)})};new Player(cosmos.resolver,"spotify:internal:queue","queue","1.0.0")'
+                 '.subscribeToQueue((e,r)=>{if(e){console.log(e);return;}chrome.queue=r.getJSONBody();});'
+                 'PlayerHelper.prototype._player=null')
+    plan.replace('zlink.spa', 'zlink.bundle.js', r'const Adaptor=function\(bridge,cosmos\)\{',
+                 'const Adaptor=function(bridge,cosmos){chrome.libURI = liburi;chrome.addToQueue=(uri,callback)=>'
+                 '{uri=liburi.from(uri);if(uri.type===liburi.Type.ALBUM){this.getAlbumTracks(uri,(err,tracks)=>'
+                 '{if(err){console.log("chrome.addToQueue",err);return};this.queueTracks(tracks,callback)})}else '
+                 'if(uri.type===liburi.Type.TRACK||uri.type===liburi.Type.EPISODE){this.queueTracks([uri],callback)}'
+                 'else{console.log("chrome.addToQueue: Only Track and Album URIs are accepted")}};'
+                 'chrome.removeFromQueue=(uri,callback)=>{if(chrome.queue){var indices=[],uriObj=liburi.from(uri);'
+                 'if(uriObj.type===liburi.Type.ALBUM){this.getAlbumTracks(uriObj,(err,tracks)=>{if(err){'
+                 'console.log(err);return}tracks.forEach(t=>chrome.queue.next_tracks.forEach((nt,index)=>'
+                 't==nt.uri&&indices.push(index)))})}else if(uriObj.type===liburi.Type.TRACK||'
+                 'uriObj.type===liburi.Type.EPISODE){chrome.queue.next_tracks.forEach((track,index)=>'
+                 'track.uri==uri&&indices.push(index))}else{console.log("chrome.removeFromQueue: Only Album, '
+                 'Track and Episode URIs are accepted")}indices=indices.reduce((a,b)=>{if(a.indexOf(b)<0){a.push('
+                 'b)}return a},[]);this.removeTracksFromQueue(indices,callback)}}; ')
     # Register song change event
-    replace_in_file('zlink.spa', 'zlink.bundle.js', r'this\._uri=track\.uri,this\._trackMetadata=track\.metadata',
-                    'this._uri=track.uri,this._trackMetadata=track.metadata,'
-                    'chrome.player&&chrome.player.dispatchEvent(new Event("songchange"))')
+    plan.replace('zlink.spa', 'zlink.bundle.js', r'this\._uri=track\.uri,this\._trackMetadata=track\.metadata',
+                 'this._uri=track.uri,this._trackMetadata=track.metadata,'
+                 'chrome.player&&chrome.player.dispatchEvent(new Event("songchange"))')
     # Register play/pause state change event
-    replace_in_file('zlink.spa', 'zlink.bundle.js', r'(this\.playing\(data\.is_playing&&!data\.is_paused\).*?;)',
-                    r'\1(this.playing()!==this._isPlaying)&&(this._isPlaying=this.playing(),'
-                    r'chrome.player&&chrome.player.dispatchEvent(new Event("onplaypause")));')
+    plan.replace('zlink.spa', 'zlink.bundle.js', r'(this\.playing\(data\.is_playing&&!data\.is_paused\).*?;)',
+                 r'\1(this.playing()!==this._isPlaying)&&(this._isPlaying=this.playing(),'
+                 r'chrome.player&&chrome.player.dispatchEvent(new Event("onplaypause")));')
     # Register progress change event
-    replace_in_file('zlink.spa', 'zlink.bundle.js', r'(PlayerUI\.prototype\._onProgressBarProgress=function.*?{)',
-                    r'\1chrome.player&&chrome.player.dispatchEvent(new Event("onprogress"));')
+    plan.replace('zlink.spa', 'zlink.bundle.js', r'(PlayerUI\.prototype\._onProgressBarProgress=function.*?{)',
+                 r'\1chrome.player&&chrome.player.dispatchEvent(new Event("onprogress"));')
     # Leak Cosmos API to chrome.cosmosAPI
-    replace_in_file('zlink.spa', 'zlink.bundle.js', r'(var _spotifyCosmosApi2=_interop.*?;)',
-                    r'\1chrome.cosmosAPI=_spotifyCosmosApi2.default;')
+    plan.replace('zlink.spa', 'zlink.bundle.js', r'(var _spotifyCosmosApi2=_interop.*?;)',
+                 r'\1chrome.cosmosAPI=_spotifyCosmosApi2.default;')
 
     for ext in (extensions if extensions is not None else []):
-        inject_js('zlink.spa', ext)
+        plan.inject('zlink.spa', ext)
 
 
-def inject_apps(app_page_logger, app_menu_items):
-    replace_in_file('zlink.spa', 'zlink.bundle.js', r'(PAGE_LOGGER_MAP={)', rf'\1{app_page_logger}')
-    replace_in_file('zlink.spa', 'mzlinkain.bundle.js', r'(return _pageIdentifiers2\.default\[normalizedAppId\]\|\|)('
-                                                   r'_pageIdentifiers\.default\.unknownUncovered)',
-                    r'\1normalizedAppId||\2')
-    replace_in_file('zlink.spa', 'zlink.bundle.js', r'(NavigationBar\.prototype\._initCollectionSection=function\(\){)',
-                    rf'\1this.sections.push({{id:"custom-apps",label:"Your Apps",items: ko.observableArray(['
-                    rf'{app_menu_items}])}});')
+def inject_apps(plan, app_page_logger, app_menu_items):
+    plan.replace('zlink.spa', 'zlink.bundle.js', r'(PAGE_LOGGER_MAP={)', rf'\1{app_page_logger}')
+    plan.replace('zlink.spa', 'zlink.bundle.js', r'(return _pageIdentifiers2\.default\[normalizedAppId\]\|\|)('
+                                                 r'_pageIdentifiers\.default\.unknownUncovered)',
+                 r'\1normalizedAppId||\2')
+    plan.replace('zlink.spa', 'zlink.bundle.js', r'(NavigationBar\.prototype\._initCollectionSection=function\(\){)',
+                 rf'\1this.sections.push({{id:"custom-apps",label:"Your Apps",items: ko.observableArray(['
+                 rf'{app_menu_items}])}});')
 
 
 def get_app_name(app_dir):
-    with open(os.path.join(app_dir, "index.html")) as file:
-        index = file.read()
-    reg = re.search(r'// NAME:(.*?)\n', index)
-    if reg:
-        return reg.group(1).strip()
-    else:
-        return os.path.basename(app_dir)
+    index_path = os.path.join(app_dir, "index.html")
+    stat = os.stat(index_path)
+    key = (index_path, stat.st_size, stat.st_mtime_ns)
+    if key not in APP_NAMES:
+        # Read as bytes so an app's index.html doesn't have to match the locale's encoding, only the name is decoded
+        with open(index_path, "rb") as file:
+            index = file.read()
+        reg = re.search(rb'// NAME:(.*?)\n', index)
+        APP_NAMES[key] = reg.group(1).decode("utf-8", errors="replace").strip() if reg else os.path.basename(app_dir)
+    return APP_NAMES[key]
+
+
+def sync_dir(source_dir, destination):
+    # Mirrors source_dir into destination like copytree, but only copies files whose size or modification time differ
+    # (copy2 keeps the time, so unchanged files match) and only deletes what source_dir no longer has. Paths are
+    # normalized so the ones walked in destination compare equal to the wanted ones, also for an output like "."
+    destination = os.path.normpath(destination)
+    wanted = set()
+    copied = 0
+    for root, _, names in os.walk(source_dir, followlinks=True):
+        target_root = os.path.normpath(os.path.join(destination, os.path.relpath(root, source_dir)))
+        if os.path.lexists(target_root) and not os.path.isdir(target_root):
+            os.remove(target_root)
+        os.makedirs(target_root, exist_ok=True)
+        wanted.add(target_root)
+        for name in names:
+            source = os.path.join(root, name)
+            target = os.path.join(target_root, name)
+            wanted.add(target)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            source_stat = os.stat(source)
+            try:
+                target_stat = os.stat(target)
+            except OSError:
+                target_stat = None
+            if target_stat is None or (target_stat.st_size, target_stat.st_mtime_ns) != (source_stat.st_size,
+                                                                                         source_stat.st_mtime_ns):
+                shutil.copy2(source, target)
+                copied += 1
+    removed = 0
+    for root, dirs, names in os.walk(destination, topdown=False):
+        for name in names + dirs:
+            path = os.path.normpath(os.path.join(root, name))
+            if path in wanted:
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            removed += 1
+    return copied, removed
+
+
+def copy_apps(app_dirs, output):
+    for app_dir in app_dirs:
+        base = os.path.basename(app_dir)
+        copied, removed = sync_dir(app_dir, os.path.join(output, base))
+        debug_print(f"\t{base}: copied {copied} and removed {removed} files", 2)
 
 
-def create_apps(app_dirs, output):
+def create_apps(plan, app_dirs, output):
     app_page_logger, app_menu_items = "", ""
+    copy_apps(app_dirs, output)
     for app_dir in app_dirs:
         base = os.path.basename(app_dir)
-        destination = os.path.join(output, base)
-        if os.path.exists(destination):
-            shutil.rmtree(destination)
-        shutil.copytree(app_dir, destination)
         app_page_logger += f'"{base}":"{base}",'
         app_menu_items += f'new MenuItem("{get_app_name(app_dir)}","spotify:app:{base}",' \
                           f'{{activeRegexp:/spotify:app:{base}(\\:.*)?$/}}),'
-    inject_apps(app_page_logger, app_menu_items)
+    inject_apps(plan, app_page_logger, app_menu_items)
+
+
+def build_spa(file, output_file, plan, extensions, user_css):
+    # Extracts one archive, rewrites it in place and compiles it again
+    filename = os.path.basename(file)
+    debug_print(f"\tExtracting: {filename}", 2)
+
+    sub_dir_path = os.path.join(current_builder().temp_dir, filename)
+
+    with profile_stage("extract", filename), zipfile.ZipFile(file, "r") as spa:
+        spa.extractall(path=sub_dir_path)
+
+    with profile_stage("process_css", filename):
+        process_css(sub_dir_path)
+
+    with profile_stage("process_html", filename):
+        process_html(sub_dir_path, extensions)
+
+    with profile_stage("inject_css", filename):
+        inject_css(sub_dir_path, user_css=user_css)
+
+    with profile_stage("mod_js", filename):
+        plan.apply(sub_dir_path)
+
+    debug_print(f"\tCompiling {filename}", 2)
+    with profile_stage("compile", filename):
+        shutil.make_archive(output_file, "zip", sub_dir_path)
+    shutil.rmtree(sub_dir_path)
+    return install_archive(output_file + ".zip", output_file)
+
+
+def retheme_spa(file, output_file, user_css_data):
+    # Copies a riced archive with only its css/user.css swapped out, every other member stays compressed as it is
+    filename = os.path.basename(file)
+    debug_print(f"\tTheming: {filename}", 2)
+    with profile_stage("retheme", filename), zipfile.ZipFile(file, "r") as src, \
+            zipfile.ZipFile(output_file + ".zip", "w", zipfile.ZIP_DEFLATED) as dst:
+        user_css_info = None
+        for info in src.infolist():
+            if info.filename == "css/user.css":
+                user_css_info = info
+            else:
+                copy_raw_member(src, dst, info)
+        zinfo = zipfile.ZipInfo("css/user.css")
+        zinfo.external_attr = 0o644 << 16
+        if user_css_info is not None:
+            zinfo.date_time = user_css_info.date_time
+            zinfo.external_attr = user_css_info.external_attr
+        dst.writestr(zinfo, user_css_data, zipfile.ZIP_DEFLATED)
+    return install_archive(output_file + ".zip", output_file)
+
+
+def archive_contents(file):
+    with zipfile.ZipFile(file, "r") as spa:
+        return sorted((info.filename, info.CRC, info.file_size, info.external_attr) for info in spa.infolist())
+
+
+def install_archive(new_file, output_file):
+    # Archives are always built next to output_file and swapped in with os.replace, so an interrupted run never
+    # leaves a half written archive behind (or writes through a hard link into the backup). The swap is skipped when
+    # the members are the same (names, sizes and CRC-32s, timestamps aside) to leave unchanged archives alone.
+    try:
+        unchanged = archive_contents(new_file) == archive_contents(output_file)
+    except (OSError, zipfile.BadZipFile):
+        unchanged = False
+    if unchanged:
+        os.remove(new_file)
+        return False
+    os.replace(new_file, output_file)
+    return True
+
+
+def load_themes(themes_dir, default_user_css):
+    # Every subdirectory is a theme made of an optional ricetify.conf, of which only the colours are used, and an
+    # optional user.css. Whatever a theme leaves out comes from the main config and user CSS, and so do the
+    # Javascript options, which all themes share.
+    themes = []
+    for theme_dir in sorted(glob.glob(os.path.join(themes_dir, "*", ""))):
+        name = os.path.basename(os.path.dirname(theme_dir))
+        config_path = os.path.join(theme_dir, "ricetify.conf")
+        user_css = os.path.join(theme_dir, "user.css")
+        if not os.path.isfile(config_path) and not os.path.isfile(user_css):
+            continue
+        colours = None
+        if os.path.isfile(config_path):
+            theme_config = configparser.ConfigParser()
+            theme_config.read(config_path)
+            if 'Javascript' in theme_config:
+                print(f"Warning: theme {name} has Javascript options, only those of the main config are used")
+            if 'Colours' in theme_config:
+                colours = theme_config['Colours']
+        if not os.path.isfile(user_css):
+            user_css = default_user_css
+        themes.append((name, generate_user_css(user_css, colours)))
+    return themes
+
+
+def hash_file(path, digest):
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest
+
+
+def build_key(file, checksum, plan, extensions, user_css):
+    # Hashes everything an output archive is made from: the backup archive (by the checksum make_backup() just
+    # verified, so it isn't read again), this script, the generated user.css (colours and user CSS), the extensions
+    # linked from the html and the JS patches and scripts injected into this archive (Javascript options, extensions
+    # and apps)
+    filename = os.path.basename(file)
+    key = hashlib.sha256(checksum.encode())
+    hash_file(os.path.abspath(__file__), key)
+    key.update(generate_user_css(user_css))
+    key.update(repr([os.path.basename(ext) for ext in extensions or []]).encode())
+    key.update(repr([(js_filename, plan.patches[(filename, js_filename)])
+                     for js_filename in plan.js_files(filename)]).encode())
+    for js_path in plan.injections.get(filename, []):
+        key.update(os.path.basename(js_path).encode())
+        hash_file(js_path, key)
+    return key.hexdigest()
+
+
+def cached_build(function, cache_dir, file, output_file, plan, extensions, user_css, checksum):
+    # Reuses the archive of a previous riced build with identical inputs instead of running function to build it
+    # again. Only the latest build of every archive is kept.
+    filename = os.path.basename(file)
+    with profile_stage("total", filename):
+        changed = build_cached(function, cache_dir, file, output_file, plan, extensions, user_css, checksum)
+    add_profile(["files", filename, "archive_size_in"], os.path.getsize(file))
+    add_profile(["files", filename, "archive_size_out"], os.path.getsize(output_file))
+    return changed
+
+
+def build_cached(function, cache_dir, file, output_file, plan, extensions, user_css, checksum):
+    if cache_dir is None:
+        return function(file, output_file, plan, extensions, user_css)
+    filename = os.path.basename(file)
+    with profile_stage("cache_key", filename):
+        cached_file = os.path.join(cache_dir, f"{filename}-{build_key(file, checksum, plan, extensions, user_css)}")
+    # Builders in other threads share the cache and may evict this entry at any time, a missing entry is a miss
+    try:
+        shutil.copyfile(cached_file, output_file + ".tmp")
+    except FileNotFoundError:
+        pass
+    else:
+        debug_print(f"\tCached: {filename}", 2)
+        add_profile(["files", filename, "cached"], 1)
+        return install_archive(output_file + ".tmp", output_file)
+    changed = function(file, output_file, plan, extensions, user_css)
+    for stale_file in glob.glob(os.path.join(cache_dir, glob.escape(filename) + "-*")):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(stale_file)
+    # Builders in other threads may store the same archive at the same time, so the copy gets a unique name
+    with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as temp_file:
+        pass
+    shutil.copyfile(output_file, temp_file.name)
+    os.replace(temp_file.name, cached_file)
+    return changed
+
+
+def init_worker(state):
+    # Worker processes started with spawn (Windows, macOS) re-import this module, so they get a copy of the builder
+    # that started them, made from its options
+    BUILDERS.builder = Builder(**state)
+
+
+def run_task(function, task):
+    # Runs in a worker process, the stylesheet stats and profile gathered there are sent back with the result
+    builder = current_builder()
+    builder.css_stats = dict.fromkeys(builder.css_stats, 0)
+    if builder.profile is not None:
+        builder.profile = {}
+    result = function(*task)
+    return result, builder.css_stats, builder.profile
+
+
+def run_jobs(function, tasks, jobs):
+    if jobs <= 1:
+        return [function(*task) for task in tasks]
+    builder = current_builder()
+    results = []
+    with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(builder.worker_state(),)) as pool:
+        for future in [pool.submit(run_task, function, task) for task in tasks]:
+            result, stats, profile = future.result()
+            results.append(result)
+            for key, value in stats.items():
+                builder.css_stats[key] += value
+            if profile is not None:
+                merge_profile(builder.profile, profile)
+    return results
+
+
+def config_sections(config):
+    return {section: dict(config[section]) for section in config.sections()}
+
+
+def build_plan(extensions, apps, output):
+    plan = PatchPlan()
+    debug_print('Modifying JS', 0)
+    if 'Javascript' in current_builder().config:
+        mod_js(plan, extensions)
+
+    if apps:
+        debug_print('Adding apps', 0)
+        create_apps(plan, apps, output)
+    return plan
 
 
 def make_backup(backup_dir):
+    # Keeps a pristine copy of Spotify's archives and a manifest of their checksums. When Spotify is updated only the
+    # archives that actually changed are copied again, and the whole backup is verified before every run.
     if not os.path.exists(backup_dir):
         os.mkdir(backup_dir)
     version = get_spotify_version()
@@ -389,12 +1303,156 @@ def make_backup(backup_dir):
             version_in_backup = version_file.read()
     else:
         version_in_backup = ""
+    manifest_path = os.path.join(backup_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+    else:
+        # Backups made before manifests existed
+        manifest = {os.path.basename(file): hash_file(file, hashlib.sha256()).hexdigest()
+                    for file in glob.glob(os.path.join(backup_dir, '*.spa'))}
+        write_manifest(manifest_path, manifest)
+
     if version != version_in_backup:
-        for file in glob.glob(os.path.join(SPOTIFY_PATH, 'Apps', '*.spa')):
-            shutil.copy2(file, backup_dir)
+        debug_print("Updating backup", 0)
+        files = glob.glob(os.path.join(current_builder().spotify_path, 'Apps', '*.spa'))
+        for file in files:
+            filename = os.path.basename(file)
+            checksum = hash_file(file, hashlib.sha256()).hexdigest()
+            if manifest.get(filename) == checksum:
+                continue
+            with zipfile.ZipFile(file) as spa:
+                if "css/user.css" in spa.namelist():
+                    print(f"Warning: {filename} has already been modified, keeping its previous backup")
+                    continue
+            debug_print(f"\tBacking up {filename}", 2)
+            backup_file = os.path.join(backup_dir, filename)
+            shutil.copy2(file, backup_file + ".tmp")
+            os.replace(backup_file + ".tmp", backup_file)
+            manifest[filename] = checksum
+        for filename in set(manifest) - {os.path.basename(file) for file in files}:
+            os.remove(os.path.join(backup_dir, filename))
+            del manifest[filename]
+        write_manifest(manifest_path, manifest)
+        # Written last, an interrupted backup is picked up again on the next run
         with open(backup_version_path, "w") as version_file:
             version_file.write(version)
 
+    for filename, checksum in manifest.items():
+        backup_file = os.path.join(backup_dir, filename)
+        if not os.path.isfile(backup_file) or hash_file(backup_file, hashlib.sha256()).hexdigest() != checksum:
+            raise RicetifyError(f"Backup of {filename} is missing or corrupt, delete {backup_dir} and reinstall "
+                                f"Spotify to take a new one")
+    return manifest
+
+
+def write_manifest(manifest_path, manifest):
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def restore(backup_dir, output_dir, manifest):
+    # The verified backup already is the restored state, so its archives are linked (or copied where links are not
+    # possible) into the output under a temporary name, then swapped in atomically
+    for filename in sorted(manifest):
+        debug_print(f"\tRestoring {filename}", 2)
+        file = os.path.join(backup_dir, filename)
+        output_file = os.path.join(output_dir, filename)
+        if os.path.exists(output_file) and os.path.samefile(file, output_file):
+            continue
+        if os.path.lexists(output_file + ".tmp"):
+            os.remove(output_file + ".tmp")
+        try:
+            os.link(file, output_file + ".tmp")
+        except OSError:
+            shutil.copy2(file, output_file + ".tmp")
+        os.replace(output_file + ".tmp", output_file)
+
+
+def watch_snapshot(paths):
+    # Size and modification time of every file under paths, cheap enough to poll
+    snapshot = {}
+    for path in paths:
+        if os.path.isdir(path):
+            file_paths = [os.path.join(root, name) for root, _, names in os.walk(path) for name in names]
+        else:
+            file_paths = [path]
+        for file_path in file_paths:
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            snapshot[file_path] = (stat.st_size, stat.st_mtime_ns)
+    return snapshot
+
+
+def watch(builder, args, options, output_files):
+    # Polls the inputs and redoes only the work a change affects: colours and user CSS only swap css/user.css in
+    # the installed archives, extensions and apps only rebuild zlink.spa and Javascript options rebuild everything
+    groups = {"user_css": [args.user_css] if args.user_css else [], "config": [args.config] if args.config else [],
+              "extensions": args.extensions or [], "apps": args.apps or []}
+    snapshots = {group: watch_snapshot(paths) for group, paths in groups.items()}
+    debug_print("Watching for changes, press Ctrl+C to stop", 0)
+    try:
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            current = {group: watch_snapshot(paths) for group, paths in groups.items()}
+            if current == snapshots:
+                continue
+            # Editors often save a file in several steps, so wait until the inputs stay the same for a whole interval
+            settled = None
+            while current != settled:
+                settled = current
+                time.sleep(WATCH_INTERVAL)
+                current = {group: watch_snapshot(paths) for group, paths in groups.items()}
+            changed = {group for group in groups if current[group] != snapshots[group]}
+            snapshots = current
+            try:
+                apply_changes(builder, args, options, changed, output_files)
+            except (configparser.Error, ValueError, OSError, RicetifyError) as error:
+                # Usually a file saved halfway, the next save gets another try
+                print(f"Error: {error}, waiting for the next change")
+    except KeyboardInterrupt:
+        debug_print("Stopped watching", 0)
+
+
+def apply_changes(builder, args, options, changed, output_files):
+    update_css = "user_css" in changed
+    rebuild = set()
+    if "config" in changed:
+        # Parsed on its own first so a config that doesn't parse leaves the builder with the previous one
+        config = configparser.ConfigParser()
+        with open(args.config) as config_file:
+            config.read_file(config_file)
+        old_config = config_sections(builder.config)
+        new_config = config_sections(config)
+        builder.config = config
+        if old_config.get('Colours') != new_config.get('Colours'):
+            update_css = True
+        if old_config.get('Javascript') != new_config.get('Javascript'):
+            rebuild = {os.path.basename(file) for file in output_files}
+    if "extensions" in changed or "apps" in changed:
+        rebuild.add("zlink.spa")
+
+    if rebuild:
+        debug_print(f"Rebuilding {', '.join(sorted(rebuild))}", 0)
+        builder.build(only=rebuild, **options)
+    if update_css:
+        debug_print("Updating user.css", 0)
+        user_css_data = generate_user_css(args.user_css)
+        # Rebuilt archives already have the new user.css
+        files = [file for file in output_files if os.path.basename(file) not in rebuild and os.path.isfile(file)]
+        report_changes(files, [retheme_spa(file, file, user_css_data) for file in files], args.output or os.curdir)
+
+
+def report_changes(files, results, output_dir):
+    changed = [os.path.relpath(file, output_dir) for file, result in zip(files, results) if result]
+    if changed:
+        debug_print(f"Changed {len(changed)} of {len(files)} archives: {', '.join(sorted(changed))}", 0)
+    else:
+        debug_print(f"All {len(files)} archives were already up to date", 0)
+
 
 class FullPaths(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
@@ -423,9 +1481,225 @@ def is_app_folder(folder_name):
         return folder_name
 
 
-def main():
-    global GLOBAL_VERBOSITY
+class Builder:
+    # Everything one build works with: its config and options, the workspace and the stats. Nothing is set up before
+    # it is needed, and builders only share the backup (behind BACKUP_LOCK) and the caches in cache_root, whose
+    # entries are written atomically and may disappear at any time, so a long running process can keep several and
+    # run them at once in different threads. The functions of this module find the builder they work for with
+    # current_builder(), which build() and restore() set for the thread they run in.
+    def __init__(self, config=None, verbosity=0, home_dir=None, spotify_path=None, ricetify_folder=None,
+                 profile=False, temp_dir=None, css_cache_dir=None):
+        # config is a path, a ConfigParser or a dict of sections
+        self.config = configparser.ConfigParser()
+        if isinstance(config, (dict, configparser.ConfigParser)):
+            self.config.read_dict(config)
+        elif config is not None:
+            self.config.read(config)
+        self.verbosity = verbosity
+        self.home_dir = home_dir if home_dir is not None else default_home_dir()
+        self.spotify_path = spotify_path if spotify_path is not None else default_spotify_path()
+        self.ricetify_folder = ricetify_folder or os.path.dirname(os.path.abspath(__file__))
+        self.profile = {} if profile else None
+        self.profile_overhead = 0.0
+        self.css_cache_dir = css_cache_dir
+        self.css_stats = {"reused": 0, "converted": 0, "bytes_saved": 0}
+        # Converted stylesheets by the hash of their source, kept for one build so a long running builder doesn't
+        # hold on to every stylesheet it has seen
+        self.css_memo = {}
+        self.workspace = None
+        self.shared_temp_dir = temp_dir
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.workspace is not None:
+            self.workspace.cleanup()
+            self.workspace = None
+
+    @property
+    def temp_dir(self):
+        if self.shared_temp_dir is not None:
+            return self.shared_temp_dir
+        if self.workspace is None:
+            self.workspace = tempfile.TemporaryDirectory(prefix="ricetify-")
+        return self.workspace.name
+
+    @property
+    def backup_dir(self):
+        return os.path.join(self.home_dir, ".spotify_backup")
+
+    @property
+    def cache_root(self):
+        return os.path.join(self.home_dir, ".ricetify_cache")
+
+    def worker_state(self):
+        # Worker processes share the workspace and caches of this builder
+        return {"config": config_sections(self.config), "verbosity": self.verbosity, "home_dir": self.home_dir,
+                "spotify_path": self.spotify_path, "ricetify_folder": self.ricetify_folder,
+                "profile": self.profile is not None, "temp_dir": self.temp_dir, "css_cache_dir": self.css_cache_dir}
+
+    @contextlib.contextmanager
+    def activate(self):
+        previous = getattr(BUILDERS, "builder", None)
+        BUILDERS.builder = self
+        try:
+            yield self
+        finally:
+            BUILDERS.builder = previous
+
+    def restore(self, output_dir=None):
+        with self.activate():
+            with profile_stage("backup"), BACKUP_LOCK:
+                manifest = make_backup(self.backup_dir)
+            debug_print("Restoring files", 0)
+            with profile_stage("restore"):
+                restore(self.backup_dir, output_dir or os.curdir, manifest)
+
+    def analyze(self, cache=True):
+        # Colour coverage of the backed up stylesheets, see analyze_colours(). Cached per Spotify version and
+        # replacement table.
+        with self.activate():
+            with profile_stage("backup"), BACKUP_LOCK:
+                manifest = make_backup(self.backup_dir)
+            # Results also depend on how colours are looked for, so like cached builds they're keyed on this script
+            script_hash = hash_file(os.path.abspath(__file__), hashlib.sha256()).hexdigest()[:8]
+            with open(os.path.join(self.backup_dir, "version.txt")) as version_file:
+                cache_file = os.path.join(self.cache_root, "colours",
+                                          f"{css_cache_name(version_file.read())}-{script_hash}.json")
+            if cache:
+                # Another builder may prune the file between checking for it and reading it
+                with contextlib.suppress(FileNotFoundError), open(cache_file) as analysis_file:
+                    debug_print(f"Using cached analysis {cache_file}", 1)
+                    return json.load(analysis_file)
+            debug_print("Analyzing stylesheets", 0)
+            with profile_stage("analyze"):
+                colours = analyze_colours(self.backup_dir, manifest)
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            for stale_file in glob.glob(os.path.join(self.cache_root, "colours", "*.json")):
+                if stale_file != cache_file:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(stale_file)
+            with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(cache_file), delete=False) as analysis_file:
+                json.dump(colours, analysis_file, indent=4, sort_keys=True)
+            os.replace(analysis_file.name, cache_file)
+            return colours
+
+    def build(self, output_dir=None, user_css=None, extensions=None, apps=None, stream=False, jobs=1, cache=True,
+              themes=None, only=None):
+        # Builds the archives named in only, or all of them, and returns the paths they were written to
+        with self.activate():
+            return self.rice(output_dir or os.curdir, user_css, extensions, apps, stream, jobs, cache, themes, only)
+
+    def rice(self, output_dir, user_css, extensions, apps, stream, jobs, cache, themes_dir, only):
+        backup_dir = self.backup_dir
+        cache_dir = os.path.join(self.cache_root, "builds") if cache else None
+        self.css_stats = dict.fromkeys(self.css_stats, 0)
+        self.css_memo = {}
+
+        with profile_stage("backup"), BACKUP_LOCK:
+            manifest = make_backup(backup_dir)
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(os.path.join(backup_dir, "version.txt")) as version_file:
+                self.css_cache_dir = os.path.join(self.cache_root, "css", css_cache_name(version_file.read()))
+            os.makedirs(self.css_cache_dir, exist_ok=True)
+            for stale_dir in glob.glob(os.path.join(self.cache_root, "css", "*")):
+                if stale_dir != self.css_cache_dir:
+                    shutil.rmtree(stale_dir, ignore_errors=True)
+        else:
+            # Still share converted stylesheets between workers for the length of this run
+            self.css_cache_dir = os.path.join(self.temp_dir, "css_cache")
+            os.makedirs(self.css_cache_dir, exist_ok=True)
+
+        themes = None
+        build_dir = output_dir
+        if themes_dir:
+            themes = load_themes(themes_dir, user_css)
+            if not themes:
+                raise RicetifyError(f"No themes found in {themes_dir}")
+            # The archives are riced once and every theme only gets its own css/user.css on top
+            build_dir = os.path.join(self.temp_dir, "themed")
+            os.makedirs(build_dir, exist_ok=True)
+
+        with profile_stage("plan"):
+            plan = build_plan(extensions, apps, build_dir)
+
+        # Every archive is independent once the JS patch plan is known, so they can be built in any order. The
+        # largest ones go first to keep the workers evenly loaded.
+        files = sorted((os.path.join(backup_dir, filename) for filename in manifest
+                        if only is None or filename in only), key=os.path.getsize, reverse=True)
+        function = stream_spa if stream else build_spa
+        tasks = [(function, cache_dir, file, os.path.join(build_dir, os.path.basename(file)), plan, extensions,
+                  user_css, manifest[os.path.basename(file)]) for file in files]
+        debug_print("Streaming files" if stream else "Building files", 0)
+        with profile_stage("build"):
+            results = run_jobs(cached_build, tasks, jobs)
+        if not themes:
+            report_changes([task[3] for task in tasks], results, output_dir)
+
+        if themes:
+            debug_print("Theming files", 0)
+            theme_tasks = []
+            for name, user_css_data in themes:
+                theme_dir = os.path.join(output_dir, name)
+                os.makedirs(theme_dir, exist_ok=True)
+                if apps:
+                    copy_apps(apps, theme_dir)
+                theme_tasks += [(os.path.join(build_dir, os.path.basename(file)),
+                                 os.path.join(theme_dir, os.path.basename(file)), user_css_data) for file in files]
+            with profile_stage("theme"):
+                results = run_jobs(retheme_spa, theme_tasks, jobs)
+            report_changes([task[1] for task in theme_tasks], results, output_dir)
+
+        for filename in plan.filenames() - set(manifest):
+            print(f"Warning: {filename} does not exist, skipped its patches")
+
+        stylesheets = self.css_stats["reused"] + self.css_stats["converted"]
+        if stylesheets:
+            reused = self.css_stats['reused']
+            debug_print(f"Reused {reused} of {stylesheets} stylesheets ({reused / stylesheets:.0%}), "
+                        f"skipped converting {self.css_stats['bytes_saved']} bytes", 1)
+        return [task[3] for task in tasks]
+
+
+def run_cli(builder, args):
+    if args.analyze:
+        run, options = builder.analyze, {"cache": not args.no_cache}
+    elif args.restore:
+        run, options = builder.restore, {"output_dir": args.output}
+    else:
+        run = builder.build
+        options = {"output_dir": args.output, "user_css": args.user_css, "extensions": args.extensions,
+                   "apps": args.apps, "stream": args.stream, "jobs": args.jobs, "cache": not args.no_cache,
+                   "themes": args.themes}
+    start = time.perf_counter()
+    if args.cprofile:
+        profiler = cProfile.Profile()
+        result = profiler.runcall(run, **options)
+        profiler.dump_stats(args.cprofile)
+    else:
+        result = run(**options)
 
+    if args.profile:
+        builder.profile["seconds"] = time.perf_counter() - start
+        builder.profile["jobs"] = args.jobs
+        builder.profile["stream"] = args.stream
+        with open(args.profile, "w") as profile_file:
+            json.dump(builder.profile, profile_file, indent=4, sort_keys=True)
+        debug_print(f"Wrote profile to {args.profile}", 0)
+
+    if args.analyze:
+        print_colour_report(result, args.verbosity)
+    elif args.watch:
+        watch(builder, args, options, result)
+
+
+def main():
     parser = argparse.ArgumentParser(description="Rice spotify")
     parser.add_argument('-u', '--user-css', help="Apply custom CSS", action=FullPaths, type=is_file)
     parser.add_argument('-o', '--output', help='Output folder', action=FullPaths, type=is_folder)
@@ -435,62 +1709,32 @@ def main():
     parser.add_argument('-e', '--extensions', help="A list of extensions to inject", nargs='+', type=is_file)
     parser.add_argument('-a', '--apps', help='A list of apps to inject', nargs='+', type=is_app_folder)
     parser.add_argument('-r', '--restore', help='Restore spotify to default', action="store_true")
+    parser.add_argument('-s', '--stream', help='Rewrite archives in memory instead of extracting them to disk',
+                        action="store_true")
+    parser.add_argument('-j', '--jobs', help='Number of archives to build in parallel', type=int, default=1)
+    parser.add_argument('--no-cache', help='Rebuild every archive instead of reusing unchanged ones',
+                        action="store_true")
+    parser.add_argument('-t', '--themes', help='Build one output folder per theme in this folder, each with an '
+                                               'optional ricetify.conf and user.css', action=FullPaths,
+                        type=is_folder)
+    parser.add_argument('-w', '--watch', help='Keep running and apply changes to the user CSS, config, extensions '
+                                              'and apps as they are saved', action="store_true")
+    parser.add_argument('--profile', help='Write per stage, per archive and per rule timings to a JSON file',
+                        action=FullPaths)
+    parser.add_argument('--cprofile', help='Write cProfile stats of the run to a file (only covers worker '
+                                           'processes with -j 1)', action=FullPaths)
+    parser.add_argument('--analyze', help="List the colours in Spotify's stylesheets, which role each maps to and "
+                                           "the nearest role for unmapped ones (-v 1 and 2 add locations)",
+                        action="store_true")
     args = parser.parse_args()
-
-    GLOBAL_VERBOSITY = args.verbosity
-
-    if args.config:
-        CONFIG.read(args.config)
-
-    if 'SUDO_USER' in os.environ:
-        home_dir = os.path.expanduser(f"~{os.getenv('SUDO_USER')}")
-    else:
-        home_dir = str(Path.home())
-    backup_dir = os.path.join(home_dir, ".spotify_backup")
-
-    make_backup(backup_dir)
-
-    # Extract all files and process css and html (javascript involves modifying many files)
-    debug_print("Extracting files", 0)
-    for file in glob.glob(os.path.join(backup_dir, '*.spa')):
-        filename = os.path.basename(file)
-        debug_print(f"\tExtracting: {filename}", 2)
-
-        sub_dir_path = os.path.join(TEMP_DIR_PATH, filename)
-
-        with zipfile.ZipFile(file, "r") as spa:
-            spa.extractall(path=sub_dir_path)
-
-        if not args.restore:
-            process_css(sub_dir_path)
-
-            process_html(sub_dir_path, args.extensions)
-
-            inject_css(sub_dir_path, user_css=args.user_css)
-
-    if not args.restore:
-        debug_print('Modifying JS', 0)
-        if 'Javascript' in CONFIG:
-            mod_js(args.extensions)
-
-        if args.apps:
-            debug_print('Adding apps', 0)
-            if args.output:
-                create_apps(args.apps, args.output)
-            else:
-                create_apps(args.apps, os.curdir)
-
-    # Recompile and move to output
-    debug_print("Compiling files", 0)
-    for folder in glob.glob(os.path.join(TEMP_DIR_PATH, '*.spa')):
-        folder_name = os.path.basename(folder)
-        debug_print(f"\tCompiling {os.path.basename(folder_name)}", 2)
-        if args.output:
-            output_file = os.path.join(args.output, folder_name)
-        else:
-            output_file = os.path.join(os.curdir, folder_name)
-        shutil.make_archive(output_file, "zip", folder)
-        shutil.move(output_file + ".zip", output_file)
+    if args.watch and (args.restore or args.themes or args.analyze):
+        parser.error("--watch can't be combined with --restore, --themes or --analyze")
+
+    try:
+        with Builder(args.config, args.verbosity, profile=bool(args.profile)) as builder, builder.activate():
+            run_cli(builder, args)
+    except RicetifyError as error:
+        sys.exit(str(error))
 
 
 if __name__ == "__main__":